@@ -0,0 +1,892 @@
+#!/usr/bin/python3
+"""Compute the exact results of the Arbor "Gift your Attar" grind.
+
+The Arbor page (worker.js) estimates Echoes/Action and friends by simulating
+num_trials trips to the Arbor. This script instead treats the grind as a
+Markov chain: every state that the simulation can be in at the start of an
+action (Attar, Permission to Linger, street, Near/Far Arbor and whether
+we're converting) is a state of the chain, with transitions built from the
+same challenge() probabilities and choices of actions as worker.js. The
+long-run rewards per action then come from the stationary distribution of
+the chain, which is solved for exactly with sparse linear algebra, so there
+is no sampling noise.
+
+The knobs are the same as on the page, with the same defaults. --check runs
+the simulation in worker.js (using node) with the same knobs, and compares.
+
+--sweep runs every combination of a set of values of the knobs, using a pool
+of processes, and prints a table of the results. --simulate runs the same
+simulation as worker.js instead of solving exactly, in batches of many runs
+and configs at once, as numpy arrays; it's the only way to run --spy.
+
+Requires the non-standard libraries numpy and scipy.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+
+import numpy
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse import linalg
+
+# The values that are accumulated for each action (or trip), in the order
+# that reward vectors hold them. "pennies" are hundredths of an Echo, and
+# watchful, persuasive and dangerous are change points.
+REWARDS = ['pennies', 'e_i', 'watchful', 'persuasive', 'dangerous',
+    'actions', 'trips']
+Reward = collections.namedtuple('Reward', REWARDS, defaults=[0] * len(REWARDS))
+NO_REWARD = Reward()
+
+# Permission to Linger at the start of each trip.
+TRIP_PERMISSION = 7
+# Actions that entering and leaving the Arbor take, per trip.
+TRIP_ACTIONS = 2
+
+NEAR_CHOICES = ['explore', 'tend', 'labour']
+FAR_CHOICES = ['walk', 'witness', 'surrender', 'shepherd']
+
+# The defaults of the knobs on the page.
+DEFAULT_KNOBS = {
+  'watchful': 167,
+  'persuasive': 20,
+  'dangerous': 125,
+  'gear_diff': 50,
+  'rare_chance': 22.5,
+  'num_trials': 100000,
+  'attar_limit': 1000,
+  'near_choice': 'explore',
+  'far_choice': 'walk',
+}
+
+# Most states that the exact solver builds the chain for. There are about a
+# dozen per point of attar_limit (and building takes about 30us each), so
+# this allows attar_limit up to about 9000.
+MAX_CHAIN_STATES = 100000
+
+# --simulate splits the --num-trials of each config between many runs
+# ("lanes"), which are simulated side by side, so that each numpy operation
+# does a lot of work. Trips of spying are independent, so a lane of spying
+# only needs a few. Gifting Attar isn't like that: a lane that stops while
+# it's building up Attar comes out high, even counting the Attar at
+# ATTAR_PENNIES, since gifting it would take more actions. So a lane of
+# gifting starts counting once it's back in the Near Arbor (or the city
+# washes away) after a burn-in, and runs on past its share of trips until
+# it's back there again, so that it counts whole cycles of building up Attar
+# and gifting it. A config that hovers at a lot of Attar can take a long time
+# to be back, so lanes only wait for up to their share of trips, each time.
+# The share is a few cycles, but at least GIFT_MIN_LANE_TRIPS, so that the
+# waiting doesn't add too much, and at most GIFT_LANE_TRIPS, since longer
+# lanes are no better for configs that are slow to be back.
+SPY_LANE_TRIPS = 10
+GIFT_LANE_CYCLES = 4
+GIFT_MIN_LANE_TRIPS = 250
+GIFT_LANE_TRIPS = 1000
+GIFT_BURN_IN_TRIPS = 20
+# Most lanes that are simulated at once, by one process, in chunks of whole
+# configs. Fewer makes each step of the simulation less efficient, and more
+# makes it slower, once the arrays don't fit in the cache.
+SWEEP_CHUNK_LANES = 2 ** 14
+
+WORKER_JS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'worker.js')
+# Number of independent simulations of --num-trials trials that --check runs,
+# to estimate the standard error of the simulated results. Each has the full
+# number of trials, since shorter runs are biased low: they end with Attar
+# that hasn't been converted yet.
+CHECK_RUNS = 10
+# How far the simulated Echoes/Action can be from the exact one before --check
+# reports a mismatch: this many standard errors, plus the relative error of
+# being off by this many trips, for the start-up of the simulation.
+CHECK_MAX_ERRORS = 4.0
+CHECK_STARTUP_TRIPS = 20
+
+# Loads worker.js and runs simulate_<which>(knobs) in it the given number of
+# times, printing the results as JSON. Called with the path of worker.js, the
+# name of the simulation, the knobs (as JSON) and the number of runs.
+NODE_RUNNER = '''
+const fs = require("fs");
+const vm = require("vm");
+const [path, which, knobs, runs] = process.argv.slice(1);
+const context = vm.createContext({});
+vm.runInContext(fs.readFileSync(path, "utf8"), context);
+const results = [];
+for (let i = 0; i < runs; ++i) {
+  results.push(context["simulate_" + which](JSON.parse(knobs)));
+}
+console.log(JSON.stringify(results));
+'''
+
+
+def add_rewards(a, b):
+  return Reward(*map(sum, zip(a, b)))
+
+
+def challenge(value, base):
+  '''Get the (probability, success change points, failure change points) of
+  a challenge, as in challenge() in worker.js.
+
+  The probability is left unclamped, as it is there; a probability above 1
+  always succeeds.
+  '''
+  prob = max(value, 0) * .6 / base
+  category = min(10, math.ceil(math.floor(100 * prob) / 10))
+  return (prob, [6, 6, 5, 5, 4, 3, 3, 2, 2, 2, 1][category],
+      [4, 4, 3, 3, 2, 1, 1, 1, 1, 1, 1][category])
+
+
+# What happens on a success or failure of an action: the change in Attar, the
+# rewards and any Permission to Linger spent beyond the usual one, plus Attar
+# and pennies for each remaining Permission (for the actions that use it all
+# up).
+OUTCOME_FIELDS = ['attar', 'pennies', 'e_i', 'watchful', 'persuasive',
+    'dangerous', 'permission', 'attar_per_permission',
+    'pennies_per_permission']
+Outcome = collections.namedtuple('Outcome', OUTCOME_FIELDS,
+    defaults=[0] * len(OUTCOME_FIELDS))
+# An action: its chance of success (clamped to [0, 1]), the Outcome of each
+# result, the street it's on, and whether it ends the trip (by using up all
+# of the Permission).
+Action = collections.namedtuple('Action',
+    ['prob', 'success', 'failure', 'street', 'ends_trip'])
+
+
+def make_action(prob, success, failure, street, ends_trip=False):
+  return Action(min(max(prob, 0.0), 1.0), success, failure, street,
+      ends_trip)
+
+
+def get_near_action(knobs):
+  '''Get the Action for the chosen Near Arbor action, as in
+  chosen_near_distribution() in worker.js.'''
+  choice = knobs['near_choice']
+  if choice == 'explore':
+    prob, success, failure = challenge(knobs['watchful'], 75)
+    return make_action(prob, Outcome(attar=2, watchful=success),
+        Outcome(attar=-1, watchful=failure), 3)
+  if choice == 'tend':
+    return make_action(1.0, Outcome(attar_per_permission=1), Outcome(), 5,
+        True)
+  if choice == 'labour':
+    # 1x Sworn Statement for each remaining Permission on a failure.
+    prob, success, failure = challenge(knobs['dangerous'], 75)
+    return make_action(prob,
+        Outcome(attar_per_permission=1, dangerous=success),
+        Outcome(pennies_per_permission=250, dangerous=failure), 1, True)
+  raise ValueError('Unknown near_choice: %s' % choice)
+
+
+def get_far_action(knobs):
+  '''Get the Action for the chosen Far Arbor action, as in
+  chosen_far_distribution() in worker.js.'''
+  choice = knobs['far_choice']
+  if choice == 'walk':
+    prob, success, failure = challenge(knobs['watchful'], 100)
+    return make_action(prob, Outcome(attar=2, watchful=success),
+        Outcome(attar=-2, watchful=failure), 3)
+  if choice == 'witness':
+    prob, success, failure = challenge(
+        knobs['watchful'] - knobs['gear_diff'], 115)
+    return make_action(prob,
+        Outcome(attar=-3, pennies=750, watchful=success),
+        Outcome(attar=2, pennies=-250, watchful=failure), 5)
+  if choice == 'surrender':
+    prob, success, failure = challenge(knobs['persuasive'], 100)
+    return make_action(prob,
+        Outcome(attar=-3, pennies=750, e_i=3, persuasive=success),
+        Outcome(attar=1, pennies=250, e_i=1, persuasive=failure), 4)
+  if choice == 'shepherd':
+    # 1x Presbyterate Passphrase for each remaining Permission; there's no
+    # challenge, so it always "fails".
+    return make_action(0.0, Outcome(),
+        Outcome(pennies_per_permission=250), 1, True)
+  raise ValueError('Unknown far_choice: %s' % choice)
+
+
+def apply_action(action, attar, permission):
+  '''Get the (probability, attar, permission, Reward) outcomes of taking an
+  action.'''
+  outcomes = []
+  for p, outcome in [(action.prob, action.success),
+      (1 - action.prob, action.failure)]:
+    if not p:
+      continue
+    reward = Reward(
+        pennies=outcome.pennies + outcome.pennies_per_permission * permission,
+        e_i=outcome.e_i, watchful=outcome.watchful,
+        persuasive=outcome.persuasive, dangerous=outcome.dangerous)
+    outcomes.append((p,
+        attar + outcome.attar + outcome.attar_per_permission * permission,
+        1 if action.ends_trip else permission + outcome.permission, reward))
+  return outcomes
+
+
+def get_spy_action(knobs):
+  '''Get the Action of simulate_spy() in worker.js, as in setup_spy().'''
+  prob, success, failure = challenge(knobs['watchful'], 75)
+  # The Action doesn't need a street, since that's all there is.
+  return make_action(prob,
+      Outcome(pennies=500, e_i=2, watchful=success),  # 2 EI
+      Outcome(permission=-1, watchful=failure), None)
+
+
+# Pennies that Attar is converted into, per Attar, by gifting it. (Rounding
+# aside, the rare success pays the same rate as the common one.)
+ATTAR_PENNIES = 1250 / 3
+
+
+def gift_attar(attar, rare_chance):
+  '''Get the (probability, attar, Reward) outcomes of gifting Attar.'''
+  outcomes = [
+      (rare_chance, 0, Reward(pennies=round(attar / 3) * 1250)),
+      (1 - rare_chance, attar - 3, Reward(pennies=1250))]
+  return [outcome for outcome in outcomes if outcome[0]]
+
+
+def start_trip(attar, streets, converting):
+  '''Get the state at the start of a trip. We lose one Attar on entrance.'''
+  return (max(attar - 1, 0), TRIP_PERMISSION, streets, attar <= 5, converting)
+
+
+def walk_towards(streets, target):
+  return streets + (streets < target) - (streets > target)
+
+
+class GiftChain:
+  '''The Markov chain of simulate_gift() in worker.js.
+
+  States are (attar, permission, streets, near, converting) tuples, as they
+  are at the top of the simulation's inner loop. Each transition is one trip
+  through that loop, and carries a Reward, which includes the actions taken
+  and whether a trip ended.
+  '''
+
+  def __init__(self, knobs):
+    self.rare_chance = knobs['rare_chance'] / 100
+    self.attar_limit = knobs['attar_limit']
+    self.near_action = get_near_action(knobs)
+    self.far_action = get_far_action(knobs)
+
+  def get_transitions(self, state):
+    '''Get the (probability, next state, Reward) transitions out of a state.'''
+    attar, permission, streets, near, converting = state
+    # Outcomes are (probability, attar, permission, streets, near,
+    # converting, Reward), before the action's Permission is spent.
+    if near:
+      if attar >= 5:
+        # Entering the Far Arbor *doesn't* cost permission.
+        return [(1, (attar, permission, 3, False, converting),
+            Reward(actions=1))]
+      if streets != self.near_action.street:
+        outcomes = [(1, attar, permission,
+            walk_towards(streets, self.near_action.street), near, converting,
+            NO_REWARD)]
+      else:
+        outcomes = [(p, max(new_attar, 0), new_permission, streets, near,
+            converting, reward) for p, new_attar, new_permission, reward in
+            apply_action(self.near_action, attar, permission)]
+    else:
+      if attar >= self.attar_limit:
+        converting = True
+      if attar < 3:
+        # The city washes away.
+        outcomes = [(1, attar, permission, streets, True, converting,
+            NO_REWARD)]
+      elif converting and streets < 5:
+        outcomes = [(1, attar, permission, streets + 1, near, converting,
+            NO_REWARD)]
+      elif converting:
+        outcomes = [(p, new_attar, permission, streets, near, new_attar >= 3,
+            reward) for p, new_attar, reward in gift_attar(
+                attar, self.rare_chance)]
+      elif streets != self.far_action.street:
+        outcomes = [(1, attar, permission,
+            walk_towards(streets, self.far_action.street), near, converting,
+            NO_REWARD)]
+      else:
+        outcomes = [(p, new_attar, new_permission, streets, near, converting,
+            reward) for p, new_attar, new_permission, reward in
+            apply_action(self.far_action, attar, permission)]
+
+    transitions = []
+    for (p, attar, permission, streets, near, converting,
+        reward) in outcomes:
+      permission -= 1
+      reward = add_rewards(reward, Reward(actions=1))
+      if permission > 0:
+        next_state = (attar, permission, streets, near, converting)
+      else:
+        next_state = start_trip(attar, streets, converting)
+        reward = add_rewards(reward, Reward(actions=TRIP_ACTIONS, trips=1))
+      transitions.append((p, next_state, reward))
+    return transitions
+
+  def initial_state(self):
+    return start_trip(0, 3, False)
+
+  def build(self):
+    '''Find all the states reachable from the initial state.
+
+    Returns the list of states, the sparse transition matrix between them,
+    and the matrix of the expected Reward of a transition out of each state.
+    Raises ValueError if there are more than MAX_CHAIN_STATES.
+    '''
+    states = [self.initial_state()]
+    index = {states[0]: 0}
+    rows = []
+    cols = []
+    probs = []
+    rewards = []
+    i = 0
+    while i < len(states):
+      expected = numpy.zeros(len(REWARDS))
+      for p, next_state, reward in self.get_transitions(states[i]):
+        if next_state not in index:
+          if len(states) >= MAX_CHAIN_STATES:
+            raise ValueError('More than %d states with attar_limit %d; use '
+                '--simulate, or a lower --attar-limit' % (
+                    MAX_CHAIN_STATES, self.attar_limit))
+          index[next_state] = len(states)
+          states.append(next_state)
+        rows.append(i)
+        cols.append(index[next_state])
+        probs.append(p)
+        expected += p * numpy.array(reward, dtype=float)
+      rewards.append(expected)
+      i += 1
+    matrix = sparse.csr_matrix((probs, (rows, cols)),
+        shape=(len(states), len(states)))
+    return states, matrix, numpy.array(rewards)
+
+
+def stationary_distribution(matrix):
+  '''Solve for the stationary distribution of a transition matrix.
+
+  Only the states in the chain's closed class (the strongly connected
+  component that can't be left) have any probability, so the equations
+  pi P = pi are only solved on those. One of the (redundant) equations is
+  dropped, and one state's probability is pinned to 1 before normalizing.
+  '''
+  size = matrix.shape[0]
+  count, labels = csgraph.connected_components(matrix, connection='strong')
+  edges = matrix.tocoo()
+  leaving = labels[edges.row[labels[edges.row] != labels[edges.col]]]
+  closed = numpy.setdiff1d(numpy.arange(count), leaving)
+  if len(closed) != 1:
+    # Then the long-run results would depend on which class the chain ends
+    # up in.
+    raise ValueError('The chain has %d closed classes' % len(closed))
+  members = numpy.flatnonzero(labels == closed[0])
+  pi = numpy.zeros(size)
+  pi[members[0]] = 1.0
+  if len(members) > 1:
+    system = (matrix[members][:, members].T -
+        sparse.identity(len(members), format='csr')).tocsr()
+    pi[members[1:]] = linalg.spsolve(system[1:, 1:].tocsc(),
+        -system[1:, 0].toarray().ravel())
+  return pi / pi.sum()
+
+
+def solve_gift(knobs):
+  '''Compute the long-run totals of simulate_gift(), as a Reward of the
+  expected amount of each per transition of the chain.'''
+  _, matrix, rewards = GiftChain(knobs).build()
+  return Reward(*(stationary_distribution(matrix) @ rewards))
+
+
+def get_results(totals):
+  '''Get the figures shown by display_results() in arbor.js, as a dict, from
+  a Reward (or anything with the same fields) of totals.'''
+  actions = totals.actions
+  return {
+    'Echoes/Action': totals.pennies * .01 / actions,
+    'Echoes/Trip': totals.pennies * .01 / totals.trips,
+    'Watchful/Action': totals.watchful / actions,
+    'Persuasive/Action': totals.persuasive / actions,
+    'Dangerous/Action': totals.dangerous / actions,
+    'EIs/Action': totals.e_i / actions,
+    'Actions/Trip': actions / totals.trips,
+  }
+
+
+def get_lanes(which, knobs, lanes=None):
+  '''Get the number of lanes that --simulate splits a config's num_trials
+  between, unless it's given, and the share of trips of each.'''
+  if not lanes:
+    share = SPY_LANE_TRIPS
+    if which == 'gift':
+      # The Attar that a trip of the far action gains, less the one lost on
+      # entrance. If it's positive, a cycle is about the trips it takes to
+      # build up to attar_limit.
+      action = get_far_action(knobs)
+      gain = TRIP_PERMISSION * (action.prob * action.success.attar +
+          (1 - action.prob) * action.failure.attar) - 1
+      cycle = knobs['attar_limit'] / gain if gain > 0 else math.inf
+      share = int(min(max(GIFT_LANE_CYCLES * cycle, GIFT_MIN_LANE_TRIPS),
+          GIFT_LANE_TRIPS))
+    lanes = min(max(knobs['num_trials'] // share, 1), SWEEP_CHUNK_LANES)
+  return lanes, -(-knobs['num_trials'] // lanes)
+
+
+class BatchSimulation:
+  '''Many independent runs ("lanes") of simulate_gift() or simulate_spy() in
+  worker.js at once, as numpy arrays with one entry per lane.
+
+  Lanes can have different knobs, so one BatchSimulation covers several
+  configs, each split into lanes by get_lanes(). Every step of the simulation
+  is one trip through the inner loop of worker.js for every lane, using one
+  random number per lane. A lane counts from the start for spying, or once
+  it's back in the Near Arbor after GIFT_BURN_IN_TRIPS for gifting. It's done
+  once it has counted its share of trips and is back where it started
+  counting (at the start of a trip for spying). Any change in its Attar is
+  counted at ATTAR_PENNIES. Lanes that are done are dropped from the arrays
+  every so often.
+
+  The Outcomes of the configs' actions are in a table, with a column for
+  doing nothing and then one for the success and one for the failure of each
+  kind of action, for each config. Rather than adding up the rewards every
+  step, lanes count the columns they take (and the Permission they had when
+  they did, for columns that pay for it), and the rewards are worked out
+  from those at the end.
+  '''
+
+  # The arrays with an entry for each lane that's still running, along their
+  # last axis.
+  LANE_ARRAYS = ['lane', 'first_column', 'near_street', 'far_street',
+      'attar_limit', 'rare_chance', 'share', 'end_trip', 'counting',
+      'done', 'tally', 'permission', 'streets', 'near', 'converting']
+
+  def __init__(self, which, configs, lanes, rng):
+    self.which = which
+    self.configs = len(configs)
+    self.rng = rng
+    self.lanes, shares = numpy.array(
+        [get_lanes(which, knobs, lanes) for knobs in configs]).T
+    size = self.lanes.sum()
+    self.lane = numpy.arange(size)
+    self.near_street = self.far_street = None
+    if which == 'gift':
+      kinds = [list(map(get_near_action, configs)),
+          list(map(get_far_action, configs))]
+      self.near_street, self.far_street = [
+          self.repeat([action.street for action in actions]).astype(numpy.int8)
+          for actions in kinds]
+    else:
+      kinds = [list(map(get_spy_action, configs))]
+    self.make_table(kinds)
+    self.attar_limit = self.repeat([knobs['attar_limit'] for knobs in configs])
+    self.rare_chance = self.repeat(
+        [knobs['rare_chance'] / 100 for knobs in configs])
+    self.share = self.repeat(shares)
+    self.end_trip = self.share.copy()
+    self.counting = numpy.full(size, which == 'spy')
+    self.done = numpy.zeros(size, dtype=bool)
+
+    # What each lane has added up, a row each: the Attar it holds, pennies
+    # from gifting Attar, actions and trips, and then the number of times it
+    # took each of its config's columns, and the total Permission it had when
+    # it did. These are copied (by lane) when the lane starts counting and
+    # when it's done. Like worker.js, the actions of entering and leaving are
+    # counted at the start of a trip.
+    self.set_tally(numpy.zeros((4 + 2 * self.columns, size), dtype=int))
+    self.start = numpy.zeros_like(self.tally)
+    self.end = numpy.zeros_like(self.tally)
+    self.actions += TRIP_ACTIONS
+    self.trips += 1
+    # The rest of the state of each lane, which starts out as
+    # start_trip(0, 3, False). Streets and Permission (and the table) are
+    # small ints, which numpy is quicker with.
+    self.permission = numpy.full(size, TRIP_PERMISSION, dtype=numpy.int8)
+    self.streets = numpy.full(size, 3, dtype=numpy.int8)
+    self.near = numpy.ones(size, dtype=bool)
+    self.converting = numpy.zeros(size, dtype=bool)
+
+  def repeat(self, values):
+    '''Repeat a value for each config for each of its lanes.'''
+    return numpy.repeat(values, self.lanes)
+
+  def set_tally(self, tally):
+    self.tally = tally
+    self.attar, self.pennies, self.actions, self.trips = tally[:4]
+    self.counts = tally[4:4 + self.columns]
+    self.permission_counts = tally[4 + self.columns:]
+
+  def make_table(self, kinds):
+    '''Build the table of Outcomes from the Actions of each config, for each
+    kind of action.
+
+    The Permission of an Outcome that ends the trip is enough to use it all
+    up.
+    '''
+    columns = []
+    for actions in zip(*kinds):
+      columns.append((Outcome(), 1.0))
+      for action in actions:
+        for outcome, prob in [(action.success, action.prob),
+            (action.failure, 0.0)]:
+          if action.ends_trip:
+            outcome = outcome._replace(permission=-TRIP_PERMISSION)
+          columns.append((outcome, prob))
+    outcomes, probs = zip(*columns)
+    self.columns = len(columns) // self.configs
+    self.table = Outcome(*numpy.array(outcomes, dtype=numpy.int16).T)
+    self.probs = numpy.array(probs, dtype=float)
+    self.first_column = self.repeat(numpy.arange(0, len(columns),
+        self.columns))
+    # The Attar of each Outcome, for each Permission that it can be taken
+    # with.
+    self.attar_table = (self.table.attar[:, None] +
+        self.table.attar_per_permission[:, None] *
+        numpy.arange(TRIP_PERMISSION + 1)).ravel()
+    self.paid_columns = [column for column in range(self.columns)
+        if self.table.pennies_per_permission[column::self.columns].any()]
+
+  def apply_actions(self, masks, random):
+    '''Take the kind of action of each mask in its lanes, like
+    apply_action(). Lanes that are doing nothing take the first column,
+    which isn't counted.'''
+    index = numpy.int8(0)
+    for kind, mask in enumerate(masks):
+      index = index + mask * numpy.int8(1 + 2 * kind)
+    index += random >= self.probs[self.first_column + index]
+    for column in range(1, self.columns):
+      taken = index == column
+      self.counts[column] += taken
+      if column in self.paid_columns:
+        self.permission_counts[column] += taken * self.permission
+    column = self.first_column + index
+    self.attar += self.attar_table[column * (TRIP_PERMISSION + 1) +
+        self.permission]
+    self.permission += self.table.permission[column]
+
+  def step_gift(self, random):
+    '''One trip through the inner loop of simulate_gift().'''
+    attar, streets, near, converting = (self.attar, self.streets, self.near,
+        self.converting)
+
+    far = ~near
+    enter_far = near & (attar >= 5)
+    converting |= far & (attar >= self.attar_limit)
+    # The city washes away.
+    wash = far & (attar < 3)
+    self.washed = wash
+    # Everyone else walks a street towards where they're going, or if they're
+    # there, acts.
+    stay = ~(enter_far | wash)
+    target = numpy.where(near, self.near_street,
+        numpy.where(converting, 5, self.far_street))
+    walk = numpy.sign(target - streets) * stay
+    act = stay & (walk == 0)
+    near_act = act & near
+    far_act = act & far & ~converting
+    gift = act & far & converting
+    streets += walk + enter_far * (3 - streets)
+    near ^= enter_far | wash
+    # gift_attar(), where Math.round(attar / 3) is (2 * attar + 3) // 6. Rare
+    # successes are rare, so they're done by index.
+    rare = gift & (random < self.rare_chance)
+    if rare.any():
+      self.pennies[rare] += (2 * attar[rare] + 3) // 6 * 1250
+      attar[rare] = 0
+    common = gift & ~rare
+    self.pennies += 1250 * common
+    attar -= 3 * common
+    converting &= ~gift | (attar >= 3)
+    self.apply_actions([near_act, far_act], random)
+    # Only exploring can take Attar below 0, and then it's 0.
+    numpy.maximum(attar, 0, out=attar)
+    # Entering the Far Arbor *doesn't* cost permission.
+    self.permission -= ~enter_far
+
+  def step_spy(self, random):
+    '''One trip through the inner loop of simulate_spy().'''
+    self.apply_actions([True], random)
+    self.permission -= 1
+
+  def finish_step(self):
+    '''Count the action of the step, start new trips in the lanes that have
+    run out of Permission, and copy the tallies of the lanes that start
+    counting or are done. Returns whether any lanes aren't done.'''
+    self.actions += 1
+    ended = self.permission <= 0
+    self.near ^= ended & (self.near ^ (self.attar <= 5))
+    self.attar -= ended & (self.attar > 0)
+    self.permission += ended * (TRIP_PERMISSION - self.permission)
+    # Lanes are back where they start counting at the start of a trip, in
+    # the Near Arbor for gifting, or when the city washes away.
+    back = ended
+    if self.which == 'gift':
+      back = ended & self.near | self.washed
+    # Lanes wait for up to their share of trips to be back.
+    start = ~self.counting & (self.trips >= GIFT_BURN_IN_TRIPS) & (back |
+        (self.trips >= GIFT_BURN_IN_TRIPS + self.share))
+    if start.any():
+      self.start[:, self.lane[start]] = self.tally[:, start]
+      self.end_trip[start] = self.trips[start] + self.share[start]
+      self.counting |= start
+    done = self.counting & ~self.done & (self.trips >= self.end_trip) & (back |
+        (self.trips >= self.end_trip + self.share))
+    if done.any():
+      self.end[:, self.lane[done]] = self.tally[:, done]
+      self.done |= done
+    self.actions += TRIP_ACTIONS * ended
+    self.trips += ended
+    if done.any() and self.done.mean() >= .5:
+      self.drop_done()
+    return len(self.lane) > 0
+
+  def drop_done(self):
+    '''Drop the lanes that are done from the arrays.'''
+    running = ~self.done
+    for name in self.LANE_ARRAYS:
+      array = getattr(self, name)
+      if array is not None:
+        setattr(self, name, array[..., running])
+    self.set_tally(self.tally)
+
+  def run(self):
+    '''Run every lane until it's done. Returns a Reward of the totals of each
+    config.'''
+    step = self.step_gift if self.which == 'gift' else self.step_spy
+    running = True
+    while running:
+      step(self.rng.random(len(self.lane)))
+      running = self.finish_step()
+    counted = numpy.add.reduceat(self.end - self.start,
+        numpy.cumsum(self.lanes) - self.lanes, axis=1)
+    attar, pennies, actions, trips = counted[:4]
+    counts = counted[4:4 + self.columns].T
+    permission = counted[4 + self.columns:].T
+    table = Outcome(*[field.reshape(self.configs, self.columns)
+        for field in self.table])
+    def total(field):
+      return (counts * field).sum(axis=1)
+    return [Reward(*config) for config in zip(
+        pennies + attar * ATTAR_PENNIES + total(table.pennies) +
+            (permission * table.pennies_per_permission).sum(axis=1),
+        total(table.e_i), total(table.watchful), total(table.persuasive),
+        total(table.dangerous), actions, trips)]
+
+
+def run_configs(which, simulate, configs, lanes, seed):
+  '''Get the results of each of a list of knob configs, either simulated
+  with a BatchSimulation or solved exactly.'''
+  if simulate or which != 'gift':
+    rng = numpy.random.default_rng(seed)
+    totals = BatchSimulation(which, configs, lanes, rng).run()
+  else:
+    totals = map(solve_gift, configs)
+  return [get_results(config_totals) for config_totals in totals]
+
+
+def run_sweep(which, simulate, configs, lanes, seed, jobs):
+  '''Run run_configs() on a list of configs, split into chunks that are run
+  by a pool of jobs processes.
+
+  Simulations run as many configs to a chunk as fit in SWEEP_CHUNK_LANES
+  lanes, and each chunk gets its own random seed, spawned from seed, so the
+  results don't depend on the number of jobs. Exact solutions are one config
+  to a chunk.
+  '''
+  chunks = []
+  chunk_lanes = SWEEP_CHUNK_LANES
+  for knobs in configs:
+    config_lanes = 1
+    if simulate or which != 'gift':
+      config_lanes = get_lanes(which, knobs, lanes)[0]
+    if chunk_lanes + config_lanes > SWEEP_CHUNK_LANES:
+      chunks.append([])
+      chunk_lanes = 0
+    chunks[-1].append(knobs)
+    chunk_lanes += config_lanes
+  seeds = numpy.random.SeedSequence(seed).spawn(len(chunks))
+  args = [(which, simulate, chunk, lanes, chunk_seed)
+      for chunk, chunk_seed in zip(chunks, seeds)]
+  if jobs == 1 or len(chunks) == 1:
+    results = itertools.starmap(run_configs, args)
+  else:
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+      try:
+        results = list(executor.map(run_configs, *zip(*args)))
+      except Exception:
+        # Don't wait for the rest of the sweep before failing.
+        executor.shutdown(cancel_futures=True)
+        raise
+  return [result for chunk_results in results for result in chunk_results]
+
+
+def simulate_with_node(which, knobs, runs):
+  '''Run simulate_<which>() in worker.js with node, runs times. Returns a list
+  of the (Reward totals, Attar left over) of each run.'''
+  output = subprocess.run(['node', '-e', NODE_RUNNER, WORKER_JS, which,
+      json.dumps(knobs), str(runs)], check=True, capture_output=True,
+      text=True).stdout
+  return [(Reward(**{field: state[field] for field in REWARDS
+      if field in state}, actions=actions, trips=state['num_trips']),
+      state['attar']) for state, actions in json.loads(output)]
+
+
+def check_gift(knobs, exact):
+  '''Compare the exact results with those simulated by worker.js, returning
+  whether they agree.
+
+  A finite simulation is biased in two ways: it ends holding Attar that
+  hasn't been converted yet, and it starts from empty. The first is
+  corrected for by counting the leftover Attar at the rate it's converted at.
+  The second is allowed for with a tolerance of CHECK_STARTUP_TRIPS trips'
+  worth of error, on top of CHECK_MAX_ERRORS standard errors.
+  '''
+  runs = simulate_with_node('gift', knobs, CHECK_RUNS)
+  per_run = numpy.array([get_results(
+      totals._replace(pennies=totals.pennies + attar * ATTAR_PENNIES)
+      )['Echoes/Action'] for totals, attar in runs])
+  mean = per_run.mean()
+  std_error = per_run.std(ddof=1) / math.sqrt(len(per_run))
+  expected = exact['Echoes/Action']
+  tolerance = (CHECK_MAX_ERRORS * std_error +
+      abs(expected) * CHECK_STARTUP_TRIPS / knobs['num_trials'])
+  print('worker.js: Echoes/Action %.4f +- %.4f (%d runs of %d trials, '
+      'counting leftover Attar); exact is %.4f, %s' % (mean, std_error,
+          len(runs), knobs['num_trials'], expected,
+          'OK' if abs(mean - expected) <= tolerance else
+          'MISMATCH (more than %.4f off)' % tolerance))
+  return abs(mean - expected) <= tolerance
+
+
+def parse_sweep(text):
+  '''Parse a --sweep argument, KNOB=VALUES, into (knob, list of values).'''
+  knob, equals, values = text.partition('=')
+  knob = knob.replace('-', '_')
+  if knob in ('near', 'far'):
+    knob += '_choice'
+  if not equals or knob not in DEFAULT_KNOBS:
+    raise argparse.ArgumentTypeError('expected KNOB=VALUES, with KNOB one of '
+        + ', '.join(DEFAULT_KNOBS))
+  choices = {'near_choice': NEAR_CHOICES, 'far_choice': FAR_CHOICES}.get(knob)
+  if choices:
+    values = choices if values == 'all' else values.split(',')
+    for value in values:
+      if value not in choices:
+        raise argparse.ArgumentTypeError('%s is not one of %s' % (
+            value, ', '.join(choices)))
+    return knob, values
+  convert = type(DEFAULT_KNOBS[knob])
+  if ':' not in values:
+    return knob, [convert(value) for value in values.split(',')]
+  # START:STOP[:STEP], which includes STOP.
+  start, stop, step = (values.split(':') + ['1'])[:3]
+  start, stop, step = convert(start), convert(stop), convert(step)
+  if step <= 0:
+    raise argparse.ArgumentTypeError('STEP must be positive')
+  # Allowing for rounding, so that 0:1:0.1 includes 1.
+  return knob, [round(start + i * step, 9)
+      for i in range(math.floor((stop - start) / step + 1e-9) + 1)]
+
+
+def print_table(knobs, configs, results, output_format):
+  '''Print the results of a sweep, with a column for each swept knob and
+  each stat.'''
+  header = knobs + list(results[0])
+  rows = [[str(config[knob]) for knob in knobs] +
+      ['%.4f' % value for value in config_results.values()]
+      for config, config_results in zip(configs, results)]
+  if output_format == 'csv':
+    writer = csv.writer(sys.stdout)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return
+  widths = [max(map(len, column)) for column in zip(header, *rows)]
+  for row in [header] + rows:
+    print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def print_results(results):
+  for name, value in results.items():
+    # Like the page, stats that don't change aren't shown.
+    if value or name in ('Echoes/Action', 'Echoes/Trip', 'Actions/Trip'):
+      print('%s: %.4f' % (name, value))
+
+
+def add_knob_arguments(parser):
+  '''Add an option for each knob on the page.'''
+  for knob in ['watchful', 'persuasive', 'dangerous', 'gear_diff',
+      'attar_limit', 'num_trials']:
+    parser.add_argument('--' + knob.replace('_', '-'), dest=knob, type=int,
+        default=DEFAULT_KNOBS[knob], help='(default: %(default)s)')
+  parser.add_argument('--rare-chance', dest='rare_chance', type=float,
+      default=DEFAULT_KNOBS['rare_chance'], help='''Rare success chance of
+      gifting Attar, in percent. (default: %(default)s)''')
+  parser.add_argument('--near', dest='near_choice', choices=NEAR_CHOICES,
+      default=DEFAULT_KNOBS['near_choice'],
+      help='Action used to gain Attar in the Near Arbor.')
+  parser.add_argument('--far', dest='far_choice', choices=FAR_CHOICES,
+      default=DEFAULT_KNOBS['far_choice'],
+      help='Action used to gain Attar in the Far Arbor.')
+
+
+def main():
+  docs = __doc__.split('\n', 1)
+  parser = argparse.ArgumentParser(description=docs[0])
+  add_knob_arguments(parser)
+  parser.add_argument('--check', action='store_true', help='''
+      Also run the simulation in worker.js (which needs node) %d times for
+      --num-trials trials, and check that it agrees with the exact results.'''
+      % CHECK_RUNS)
+  parser.add_argument('--simulate', action='store_true', help='''
+      Simulate the grind, splitting --num-trials between --lanes runs, rather
+      than solving it exactly.''')
+  parser.add_argument('--spy', action='store_true', help='''
+      Simulate spying rather than gifting Attar.''')
+  parser.add_argument('--sweep', action='append', default=[],
+      type=parse_sweep, metavar='KNOB=VALUES', help='''Run every combination
+      of the values of the swept knobs, and print a table of the results.
+      VALUES is a comma-separated list, or START:STOP[:STEP] (which includes
+      STOP), or "all" for --near and --far. Can be given more than once, e.g.
+      --sweep watchful=100:250:10 --sweep near=all --sweep far=all.''')
+  parser.add_argument('--lanes', type=int, help='''Runs to split --num-trials
+      between, when simulating. (default: as many as make the results come
+      out right, up to %d)''' % SWEEP_CHUNK_LANES)
+  parser.add_argument('--seed', type=int,
+      help='Random seed for simulating, for repeatable results.')
+  parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+      help='Processes to run --sweep with. (default: %(default)s)')
+  parser.add_argument('--format', choices=['text', 'csv'], default='text',
+      help='Format of the --sweep table. (default: %(default)s)')
+  args = parser.parse_args()
+  if args.check and (args.simulate or args.spy or args.sweep):
+    parser.error('--check only works with the exact results of one config')
+  if (args.lanes is not None and args.lanes < 1) or args.jobs < 1:
+    parser.error('--lanes and --jobs must be positive')
+  knobs = {knob: getattr(args, knob) for knob in DEFAULT_KNOBS}
+  which = 'spy' if args.spy else 'gift'
+
+  if not args.sweep:
+    try:
+      results = run_sweep(which, args.simulate, [knobs], args.lanes,
+          args.seed, 1)[0]
+    except ValueError as e:
+      parser.error(e)
+    print_results(results)
+    if args.check and not check_gift(knobs, results):
+      sys.exit(1)
+    return
+  swept = dict(args.sweep)
+  configs = [dict(knobs, **dict(zip(swept, values)))
+      for values in itertools.product(*swept.values())]
+  try:
+    results = run_sweep(which, args.simulate, configs, args.lanes, args.seed,
+        args.jobs)
+  except ValueError as e:
+    parser.error(e)
+  print_table(list(swept), configs, results, args.format)
+
+if __name__ == '__main__':
+  main()
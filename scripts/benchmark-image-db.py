@@ -0,0 +1,477 @@
+#!/usr/bin/python3
+"""Benchmark update-image-db.py against a local stand-in for the wiki and image server.
+
+A synthetic set of game files is generated, and served by a local aiohttp
+server that emulates the parts of the wiki and the image server that
+update-image-db.py uses: the category pages (with their "from=" pagination),
+the categorymembers/imageinfo query of api.php (with its continuations), the
+vignette revision URLs of the wiki images, and the server images, with
+ETag/Cache-Control headers and 304 responses to conditional requests. Each
+phase of a full run (categories, map, download, summary) is then timed on a
+fresh DB, for each of the requested numbers of images, along with refreshes
+of the server images and of the wiki images after a revision bump, and a
+listing with --api (which is checked to have found every file).
+
+The server runs in its own process, so that its work isn't counted against
+the script. The same seed always generates the same files, so runs are
+comparable with each other.
+
+Requires the same libraries as update-image-db.py.
+"""
+
+from PIL import Image
+from aiohttp import web
+import argparse
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import html
+import importlib.util
+import io
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import urllib.parse
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'update-image-db.py')
+
+# The wiki and the image server are served from the same port, but under
+# different host names, since update-image-db.py limits concurrency per host.
+WIKI_HOST = 'localhost'
+SERVER_HOST = '127.0.0.1'
+
+# Number of files on each category page; the wiki uses 200.
+CATEGORY_PAGE_SIZE = 200
+# Number of files that api.php gives the imageinfo of per response. This is
+# less than update-image-db's gcmlimit, so that, as on the real wiki, each
+# batch of files has its imageinfo split across continuations.
+API_IMAGEINFO_PAGE_SIZE = 300
+# The upload timestamp that api.php gives, which is WIKI_REVISION.
+WIKI_TIMESTAMP = '2020-03-20T22:55:32Z'
+# The max-age that server images are served with.
+SERVER_MAX_AGE = 3600
+SERVER_LAST_MODIFIED = 'Fri, 20 Mar 2020 22:55:32 GMT'
+# The revision of every wiki image, as it appears in the "cb" parameter, and
+# the revision they're all bumped to by the new-revision phase.
+WIKI_REVISION = '20200320225532'
+NEW_WIKI_REVISION = '20210320225532'
+
+# The resolution of the images in each group.
+GROUP_SIZES = {
+  'Regular': (130, 100),
+  'Small': (40, 40),
+  'Cameo': (60, 78),
+  'Headers': (800, 200),
+}
+# Number of distinct base images generated for each resolution. Files pick
+# one of these at random, so that images can be generated once and reused.
+IMAGE_POOL_SIZE = 16
+
+# How the server image of a file relates to its wiki image, with the weight
+# of each outcome. The outcomes cover each of the states that update-image-db
+# can classify a pair into.
+OUTCOMES = {
+  'same': 60,       # SAME_FILE
+  'reencoded': 10,  # SAME_PIXELS
+  'similar': 10,    # SIMILAR
+  'different': 10,  # TOO DIFFERENT
+  'resized': 5,     # SIZE MISMATCH
+  'missing': 5,     # CAN'T FETCH
+}
+
+DEFAULT_SIZES = '1000,10000,100000'
+
+
+def load_script():
+  '''Import update-image-db.py as a module.'''
+  spec = importlib.util.spec_from_file_location('update_image_db', SCRIPT)
+  module = importlib.util.module_from_spec(spec)
+  # Registered, so that worker processes can find its functions.
+  sys.modules[spec.name] = module
+  spec.loader.exec_module(module)
+  return module
+
+
+def make_corpus(count, seed):
+  '''Generate the game files, as a list of dicts with the name, category,
+  group (the key into GROUP_SIZES), image pool index and outcome of each.
+
+  About 40% of the files come in regular/small pairs, and a few are cameos
+  and headers, which are in the Cameo and Headers categories.
+  '''
+  rng = random.Random(seed)
+  outcomes = list(OUTCOMES)
+  weights = list(OUTCOMES.values())
+  files = []
+
+  def add(name, category, group):
+    files.append({'name': name, 'category': category, 'group': group,
+        'base': rng.randrange(IMAGE_POOL_SIZE),
+        'outcome': rng.choices(outcomes, weights)[0]})
+
+  stem = 0
+  while len(files) < count:
+    stem += 1
+    kind = rng.random()
+    if kind < 0.05:
+      add('File:Bench%06d header.png' % stem, 'Headers', 'Headers')
+    elif kind < 0.10:
+      add('File:Bench%06dcameo.png' % stem, 'Cameo', 'Cameo')
+    elif kind < 0.30:
+      add('File:Bench%06d.png' % stem, '', 'Regular')
+      add('File:Bench%06dsmall.png' % stem, '', 'Small')
+    else:
+      add('File:Bench%06d.png' % stem, '', 'Regular')
+  del files[count:]
+  files.sort(key=lambda f: f['name'])
+  return files
+
+
+def get_wiki_path(name):
+  '''Get the path of a wiki image, in the style of the vignette URLs.'''
+  name = name[5:].replace(' ', '_')
+  digest = hashlib.md5(name.encode()).hexdigest()
+  return '/fallenlondon/images/%s/%s/%s' % (
+      digest[0], digest[:2], urllib.parse.quote(name))
+
+
+class ImagePool:
+  '''Generates the wiki and server images of the files, caching them by
+  resolution, base image and outcome.'''
+
+  def __init__(self, seed):
+    self.seed = seed
+    self.cache = {}
+
+  def get(self, size, base, outcome):
+    '''Get the PNG data for an image, where outcome is 'wiki' for the wiki
+    image, or one of OUTCOMES for the server image.'''
+    key = (size, base, outcome)
+    if key not in self.cache:
+      self.cache[key] = self.make(size, base, outcome)
+    return self.cache[key]
+
+  def make(self, size, base, outcome):
+    if outcome == 'same':
+      return self.get(size, base, 'wiki')
+    rng = random.Random('%s/%s/%d' % (self.seed, size, base))
+    image = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+    save_args = {}
+    if outcome == 'reencoded':
+      save_args['compress_level'] = 1
+    elif outcome == 'similar':
+      # Changes each channel by at most 3, well under the SIMILAR threshold.
+      image = image.point(lambda v: v ^ 3)
+    elif outcome == 'different':
+      image = image.point(lambda v: 255 - v)
+    elif outcome == 'resized':
+      image = image.resize((size[0] + 2, size[1]))
+    data = io.BytesIO()
+    image.save(data, 'PNG', **save_args)
+    return data.getvalue()
+
+
+def make_app(module, files, seed, wiki_url, server_url):
+  '''Make the aiohttp app that stands in for both the wiki and the image
+  server.'''
+  pool = ImagePool(seed)
+  categories = {'Game_Files': files}
+  for category in module.TAG_CATEGORIES:
+    categories[category] = [f for f in files if f['category'] == category]
+  keys = {name: [f['name'][5:] for f in members]
+      for name, members in categories.items()}
+  page_ids = {f['name']: i + 1 for i, f in enumerate(files)}
+  wiki_images = {}
+  server_images = {}
+  for f in files:
+    size = GROUP_SIZES[f['group']]
+    wiki_images[get_wiki_path(f['name'])] = (size, f['base'], 'wiki')
+    group = module.get_group(f['name'], f['category'])
+    if f['outcome'] == 'missing' or group not in module.MAP_ARGS:
+      continue
+    path = urllib.parse.urlsplit(module.map_helper(
+        *module.MAP_ARGS[group], f['name'], server_url)).path
+    server_images[path] = (size, f['base'], f['outcome'])
+
+  async def category_page(request):
+    name = request.match_info['name']
+    if name not in categories:
+      raise web.HTTPNotFound()
+    members = categories[name]
+    start = bisect.bisect_left(keys[name], request.query.get('from', ''))
+    parts = ['<ul>']
+    for f in members[start:start + CATEGORY_PAGE_SIZE]:
+      title = html.escape(f['name'])
+      parts.append('''<li class="category-page__member">
+          <a href="/wiki/%s" title="%s">
+          <img src="data:image/gif;base64,R0lGODlhAQABAIABAAAAAP///yH5BAEAAAEALAAAAAABAAEAQAICTAEAOw%%3D%%3D"
+            data-src="%s%s/revision/latest/window-crop/width/40/x-offset/0/y-offset/4/window-width/100/window-height/75?cb=%s"
+            alt="%s" class="category-page__member-thumbnail lzy lzyPlcHld">
+          </a></li>''' % (urllib.parse.quote(f['name']), title, wiki_url,
+          get_wiki_path(f['name']), WIKI_REVISION, title))
+    parts.append('</ul>')
+    if start + CATEGORY_PAGE_SIZE < len(members):
+      parts.append('''<a href="%s/wiki/Category:%s?from=%s"
+          class="category-page__pagination-next wds-button wds-is-secondary">
+          Next</a>''' % (wiki_url, name,
+          keys[name][start + CATEGORY_PAGE_SIZE]))
+    return web.Response(text='\n'.join(parts), content_type='text/html')
+
+  async def api(request):
+    # Only the query that gen_category_files_api() makes is supported. The
+    # continuation values are indexes: gcmcontinue into the category, and
+    # iicontinue into the current batch of files.
+    query = request.query
+    name = query['gcmtitle'].split(':', 1)[1].replace(' ', '_')
+    if name not in categories:
+      return web.json_response({'error': {'info': 'Unknown category'}})
+    members = categories[name]
+    start = int(query.get('gcmcontinue', 0))
+    batch = members[start:start + int(query['gcmlimit'])]
+    info_start = int(query.get('iicontinue', 0))
+    info_end = info_start + API_IMAGEINFO_PAGE_SIZE
+    pages = {}
+    for i, f in enumerate(batch):
+      page = {'pageid': page_ids[f['name']], 'ns': 6, 'title': f['name']}
+      if info_start <= i < info_end:
+        path = get_wiki_path(f['name'])
+        page['imageinfo'] = [{'timestamp': WIKI_TIMESTAMP,
+            'url': '%s%s/revision/latest?cb=%s' % (
+                wiki_url, path, WIKI_REVISION),
+            'sha1': hashlib.sha1(pool.get(*wiki_images[path])).hexdigest()}]
+      pages[str(page['pageid'])] = page
+    data = {'query': {'pages': pages}}
+    if info_end < len(batch):
+      # Like MediaWiki, the generator's own continuation is sent back as it
+      # was, so that the same batch is generated again.
+      data['continue'] = {'iicontinue': str(info_end),
+          'continue': 'gcmcontinue||'}
+      if 'gcmcontinue' in query:
+        data['continue']['gcmcontinue'] = query['gcmcontinue']
+    else:
+      data['batchcomplete'] = ''
+      if start + len(batch) < len(members):
+        data['continue'] = {'gcmcontinue': str(start + len(batch)),
+            'continue': '-||'}
+    return web.json_response(data)
+
+  def image_response(request, data, headers):
+    etag = '"%s"' % hashlib.sha1(data).hexdigest()
+    headers = dict(headers, ETag=etag, **{
+        'Last-Modified': SERVER_LAST_MODIFIED})
+    if request.headers.get('If-None-Match') == etag:
+      return web.Response(status=304, headers=headers)
+    return web.Response(body=data, headers=headers, content_type='image/png')
+
+  async def wiki_image(request):
+    # Any revision is served, with the current file.
+    path = '/' + request.match_info['path'].rsplit('/revision/', 1)[0]
+    if path not in wiki_images:
+      raise web.HTTPNotFound()
+    return image_response(request, pool.get(*wiki_images[path]), {})
+
+  async def server_image(request):
+    if request.path not in server_images:
+      raise web.HTTPNotFound()
+    return image_response(request, pool.get(*server_images[request.path]),
+        {'Cache-Control': 'public, max-age=%d' % SERVER_MAX_AGE})
+
+  app = web.Application()
+  app.router.add_get('/wiki/Category:{name}', category_page)
+  app.router.add_get('/api.php', api)
+  app.router.add_get('/{path:fallenlondon/images/.*}', wiki_image)
+  app.router.add_get('/images/{path:.*}', server_image)
+  return app
+
+
+def serve(count, seed, port, ready):
+  '''Run the stand-in server, for run_server().'''
+  module = load_script()
+  files = make_corpus(count, seed)
+
+  async def run():
+    app = make_app(module, files, seed, 'http://%s:%d' % (WIKI_HOST, port),
+        'http://%s:%d' % (SERVER_HOST, port))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '', port).start()
+    ready.set()
+    await asyncio.Event().wait()
+
+  asyncio.run(run())
+
+
+def get_free_port():
+  '''Get a port number that isn't in use.'''
+  with socket.socket() as sock:
+    sock.bind(('', 0))
+    return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def run_server(count, seed):
+  '''Run the stand-in server in another process, for the duration of the
+  context. Yields the (wiki_url, server_url) to use with it.'''
+  port = get_free_port()
+  ready = multiprocessing.Event()
+  process = multiprocessing.Process(
+      target=serve, args=(count, seed, port, ready), daemon=True)
+  process.start()
+  try:
+    if not ready.wait(600):
+      raise RuntimeError('The benchmark server failed to start')
+    yield 'http://%s:%d' % (WIKI_HOST, port), 'http://%s:%d' % (
+        SERVER_HOST, port)
+  finally:
+    process.terminate()
+    process.join()
+
+
+def generate_db(module, conn, files, seed, wiki_url, server_url):
+  '''Fill a DB with the files, as a full run against the stand-in server
+  would leave it, apart from the mappings and cached states.'''
+  pool = ImagePool(seed)
+  blobs = {}
+  rows = []
+
+  def add_blob(data):
+    blob_hash = module.get_blob_hash(data)
+    if blob_hash not in blobs:
+      blobs[blob_hash] = [blob_hash, module.get_sha1(data),
+          module.get_pixel_hash(data), data]
+    return blob_hash
+
+  fetched_at = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime())
+  for f in files:
+    size = GROUP_SIZES[f['group']]
+    wiki_data = pool.get(size, f['base'], 'wiki')
+    wiki_hash = add_blob(wiki_data)
+    group = module.get_group(f['name'], f['category'])
+    server_url_row = ''
+    status = 0
+    server_hash = None
+    etag = ''
+    if group in module.MAP_ARGS:
+      server_url_row = module.map_helper(
+          *module.MAP_ARGS[group], f['name'], server_url)
+      if f['outcome'] == 'missing':
+        status = 404
+      else:
+        status = 200
+        server_data = pool.get(size, f['base'], f['outcome'])
+        server_hash = add_blob(server_data)
+        etag = '"%s"' % hashlib.sha1(server_data).hexdigest()
+    rows.append([f['name'],
+        '%s%s/revision/latest?cb=%s' % (
+            wiki_url, get_wiki_path(f['name']), WIKI_REVISION),
+        WIKI_REVISION, f['category'], module.get_sha1(wiki_data), wiki_hash,
+        server_url_row, status, etag, SERVER_LAST_MODIFIED, SERVER_MAX_AGE,
+        fetched_at, server_hash])
+  conn.executemany('''INSERT OR IGNORE INTO blobs (hash, sha1, pixel_hash, data)
+      VALUES (?, ?, ?, ?)''', blobs.values())
+  conn.executemany('''INSERT OR REPLACE INTO images (wiki_name, wiki_url,
+      wiki_revision, wiki_categories, wiki_sha1, wiki_hash, server_url,
+      server_status, server_etag, server_last_modified, server_max_age,
+      server_fetched_at, server_hash)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+  conn.execute('COMMIT')
+
+
+async def run_phases(module, count, wiki_url, server_url, jobs):
+  '''Run each phase on a fresh DB, returning a list of (phase, seconds).'''
+  timings = []
+
+  async def timed(phase, coro):
+    start = time.perf_counter()
+    # The script's progress output would only get in the way.
+    with open(os.devnull, 'w') as devnull:
+      with contextlib.redirect_stdout(devnull):
+        await coro
+    timings.append((phase, time.perf_counter() - start))
+
+  async def as_coro(fn, *args):
+    fn(*args)
+
+  with tempfile.TemporaryDirectory() as tmp:
+    module.DB_FILE = os.path.join(tmp, 'images.db')
+    conn = module.open_db()
+    module.init_db(conn)
+    async with module.make_session({}) as session:
+      await timed('categories',
+          module.update_categories(conn, session, wiki_url, False))
+      await timed('map', as_coro(module.update_map, conn, False, server_url))
+      await timed('download', module.do_download(conn, session, False))
+      # Everything is fresh now, so this is all 304s.
+      await timed('revalidate', module.do_download_server(conn, session, True))
+      # As when the wiki's files are purged: every file gets a new revision,
+      # without changing.
+      conn.execute('''UPDATE images
+          SET wiki_url = substr(wiki_url, 1, length(wiki_url) - 14) || ?''',
+          [NEW_WIKI_REVISION])
+      conn.execute('COMMIT')
+      await timed('new-revision', module.do_download_wiki(conn, session))
+      await timed('summary', as_coro(module.print_summary, conn, jobs))
+      # Last, so that the sha1s it finds don't change the other phases.
+      await timed('categories-api',
+          module.update_categories(conn, session, wiki_url, True))
+      listed = conn.execute('''SELECT count(*) FROM images
+          WHERE wiki_sha1 IS NOT NULL''').fetchone()[0]
+      if listed != count:
+        raise RuntimeError('The API listing found %d of %d files' % (
+            listed, count))
+    conn.close()
+  return timings
+
+
+def print_timings(results):
+  '''Print the wall time and throughput of each phase, for each size.'''
+  print('%10s  %-14s %10s %12s' % ('images', 'phase', 'wall (s)', 'images/s'))
+  for count, timings in results:
+    for phase, seconds in timings:
+      print('%10d  %-14s %10.2f %12.0f' % (
+          count, phase, seconds, count / seconds if seconds else 0))
+
+
+async def main():
+  docs = __doc__.split('\n', 1)
+  parser = argparse.ArgumentParser(description=docs[0])
+  parser.add_argument('--sizes', default=DEFAULT_SIZES, help='''
+      Comma-separated list of the numbers of images to benchmark with.''')
+  parser.add_argument('--seed', default='bench', help='''
+      Seed for the synthetic game files and images.''')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='''
+      Number of worker processes for the summary, as for update-image-db.''')
+  parser.add_argument('--generate-db', metavar='FILE', help='''
+      Instead of benchmarking, write a DB for the first of --sizes to FILE, as
+      a full run against the stand-in server would leave it (apart from the
+      mappings and cached states), and exit.''')
+  args = parser.parse_args()
+  sizes = [int(x) for x in args.sizes.split(',')]
+  module = load_script()
+
+  if args.generate_db:
+    module.DB_FILE = args.generate_db
+    conn = module.open_db()
+    module.init_db(conn)
+    # The URLs are those of a stand-in server on port 8080.
+    generate_db(module, conn, make_corpus(sizes[0], args.seed), args.seed,
+        'http://%s:8080' % WIKI_HOST, 'http://%s:8080' % SERVER_HOST)
+    conn.close()
+    return
+
+  results = []
+  for count in sizes:
+    print('Benchmarking %d images...' % count, file=sys.stderr, flush=True)
+    with run_server(count, args.seed) as (wiki_url, server_url):
+      results.append((count, await run_phases(
+          module, count, wiki_url, server_url, args.jobs)))
+  print_timings(results)
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -11,7 +11,8 @@ server images. Commandline flags can be used to only do certain of these
 steps.
 
 Requires the non-standard libraries aiohttp and Pillow for fast parallel
-downloads and image processing, respectively.
+downloads and image processing, respectively. If numpy is installed, it is used
+to speed up the pixel comparisons.
 """
 
 from PIL import Image, ImageChops
@@ -19,12 +20,31 @@ from datetime import datetime, timedelta, timezone
 import aiohttp
 import asyncio
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import hashlib
+import heapq
 import html
 import io
 import itertools
+import json
+import operator
+import os
+import random
 import re
 import sqlite3
+import struct
 import sys
+import time
+import types
+import urllib.parse
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 # Mutually-exclusive groups that each image can fall into. These aren't the
 # same as wiki Categories, although there is some overlap.
@@ -81,6 +101,83 @@ STATES = [STATE_UNFETCHED, STATE_CANT_FETCH, STATE_SIZE_MISMATCH,
 
 TIMEOUT = aiohttp.ClientTimeout(total=15)
 
+# The wiki that game files are listed on and downloaded from.
+WIKI_URL = 'https://fallenlondon.fandom.com'
+# The server that the game's images are served from.
+SERVER_URL = 'https://images.fallenlondon.com'
+# Number of files asked for in each MediaWiki API request. 500 is the most
+# that the API allows for non-bot users.
+API_BATCH_SIZE = 500
+
+# Maximum number of simultaneous requests to any one host. Requests beyond
+# this wait their turn, instead of all being started at once (and timing out
+# while waiting for a connection).
+MAX_REQUESTS_PER_HOST = 8
+# How long idle connections are kept open for reuse, in seconds.
+KEEPALIVE_TIMEOUT = 30
+# Number of times a request is retried after a timeout, connection error or
+# server error (5xx/429), and the base delay in seconds for the exponential
+# backoff between attempts.
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 1.0
+
+# Downloaded rows are committed every CHECKPOINT_ROWS rows or CHECKPOINT_BYTES
+# bytes of image data, whichever comes first, so that an interrupted run only
+# loses the work since the last checkpoint.
+CHECKPOINT_ROWS = 200
+CHECKPOINT_BYTES = 32 * 1024 * 1024
+# Maximum number of downloaded rows waiting to be written to the DB.
+WRITE_QUEUE_SIZE = 100
+
+# Rows are also committed when no new ones have arrived for this many
+# seconds, which matters in --watch mode.
+CHECKPOINT_SECONDS = 30
+# In --watch mode, how often (in seconds) to print a status line, and how long
+# to wait before refetching images without a max-age, or that failed.
+WATCH_STATUS_INTERVAL = 60
+WATCH_DEFAULT_TTL = 3600
+
+# A same-sized pair of images is SIMILAR when its mean squared error per pixel
+# is below this, and TOO_DIFFERENT otherwise.
+SIMILAR_MAX_ERROR = 50.0
+# get_state() first compares thumbnails shrunk by this factor, then the full
+# images in strips of about this many pixels, stopping as soon as the pair is
+# known to be TOO_DIFFERENT.
+THUMBNAIL_FACTOR = 8
+COMPARE_STRIP_PIXELS = 64 * 1024
+
+# For --find-renames, the largest Hamming distance between the dHashes of two
+# images for them to be considered a match, and the number of matches to show
+# for each image.
+RENAME_MAX_DISTANCE = 6
+RENAME_MAX_SUGGESTIONS = 3
+
+# SQLite tuning. The page size only takes effect when the DB is created. The
+# memory map makes reading blobs cheaper, and the DB is kept in WAL mode so
+# that --read-only reports can run while another process is refreshing it.
+DB_FILE = 'images.db'
+DB_PAGE_SIZE = 8192
+DB_CACHE_KIB = 64 * 1024
+DB_MMAP_SIZE = 1024 * 1024 * 1024
+# How long to wait for another process's write transaction, in seconds.
+DB_BUSY_TIMEOUT = 60
+
+# Per-host semaphores used by request(), created on demand.
+host_semaphores = {}
+
+# Upper bounds, in seconds, of the buckets of the request latency histograms.
+REQUEST_LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 15.0]
+# Prefix of the names of the metrics in Prometheus output.
+METRICS_PREFIX = 'update_image_db_'
+
+# Size of the chunks that images are copied in by --export.
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Number of image pairs sent to a worker process at a time, when comparing
+# images in parallel.
+CLASSIFY_BATCH_SIZE = 20
+
 # Map from current names on the wiki to what the it ought to be, if named
 # properly. Used to correct for one-off mistakes.
 RENAMES = {
@@ -92,7 +189,259 @@ RENAMES = {
 }
 
 
-async def gen_category_files(category, session):
+def get_status_label(status):
+  '''Get the label that requests with the given status (None if there was
+  no response) are counted under in the metrics.'''
+  if status is None:
+    return 'error'
+  if 400 <= status < 500:
+    return '4xx'
+  if status >= 500:
+    return '5xx'
+  return str(status)
+
+
+class Metrics:
+  '''Instrumentation for a run: the wall and CPU time of each phase, the
+  latencies and sizes of requests by host and status, and the time spent in
+  SQLite and in get_state().
+
+  CPU time only covers this process, not the worker processes used by
+  --jobs; get_state() times are collected from the workers, though.
+  '''
+
+  def __init__(self):
+    # Map from phase to [wall seconds, CPU seconds].
+    self.phases = {}
+    # Map from (host, status label) to a dict with the cumulative histogram
+    # bucket counts, and the total count, seconds and bytes of the requests.
+    self.requests = {}
+    # Map from activity to [calls, seconds].
+    self.timers = collections.defaultdict(lambda: [0, 0.0])
+    # Where export() writes to, as (path, format), or None to not write.
+    self.output = None
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    '''Add the time spent in the context to the named phase.'''
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+      yield
+    finally:
+      totals = self.phases.setdefault(name, [0.0, 0.0])
+      totals[0] += time.perf_counter() - wall
+      totals[1] += time.process_time() - cpu
+
+  @contextlib.contextmanager
+  def timer(self, activity):
+    '''Add the time spent in the context to the named activity.'''
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add_time(activity, 1, time.perf_counter() - start)
+
+  def add_time(self, activity, calls, seconds):
+    timer = self.timers[activity]
+    timer[0] += calls
+    timer[1] += seconds
+
+  def merge_timers(self, timers):
+    '''Add in the timers of another Metrics, e.g. from a worker process.'''
+    for activity, (calls, seconds) in timers.items():
+      self.add_time(activity, calls, seconds)
+
+  @contextlib.contextmanager
+  def request_timer(self, host):
+    '''Record a request to host made in the context. The response should be
+    set on the yielded object, if there is one.'''
+    timing = types.SimpleNamespace(response=None)
+    start = time.perf_counter()
+    try:
+      yield timing
+    finally:
+      response = timing.response
+      self.add_request(host, response and response.status,
+          time.perf_counter() - start,
+          response.content.total_bytes if response else 0)
+
+  def add_request(self, host, status, seconds, size):
+    stats = self.requests.setdefault((host, get_status_label(status)), {
+        'buckets': [0] * len(REQUEST_LATENCY_BUCKETS), 'count': 0,
+        'seconds': 0.0, 'bytes': 0})
+    for i, bound in enumerate(REQUEST_LATENCY_BUCKETS):
+      if seconds <= bound:
+        stats['buckets'][i] += 1
+    stats['count'] += 1
+    stats['seconds'] += seconds
+    stats['bytes'] += size
+
+  def to_json(self):
+    return {
+      'phases': {name: {'wall_seconds': wall, 'cpu_seconds': cpu}
+          for name, (wall, cpu) in self.phases.items()},
+      'requests': [dict(host=host, status=status, buckets=dict(zip(
+          map(str, REQUEST_LATENCY_BUCKETS), stats['buckets'])),
+          **{k: v for k, v in stats.items() if k != 'buckets'})
+          for (host, status), stats in sorted(self.requests.items())],
+      'timers': {activity: {'calls': calls, 'seconds': seconds}
+          for activity, (calls, seconds) in sorted(self.timers.items())},
+    }
+
+  def to_prometheus(self):
+    lines = []
+
+    def add(name, kind, help_text, samples):
+      lines.append('# HELP %s%s %s' % (METRICS_PREFIX, name, help_text))
+      lines.append('# TYPE %s%s %s' % (METRICS_PREFIX, name, kind))
+      for suffix, labels, value in samples:
+        lines.append('%s%s%s{%s} %s' % (METRICS_PREFIX, name, suffix,
+            ','.join('%s="%s"' % label for label in labels), value))
+
+    add('phase_seconds', 'gauge', 'Time spent in each phase of the run.',
+        [('', [('phase', name), ('clock', clock)], value)
+          for name, times in self.phases.items()
+          for clock, value in zip(['wall', 'cpu'], times)])
+    samples = []
+    for (host, status), stats in sorted(self.requests.items()):
+      labels = [('host', host), ('status', status)]
+      for bound, count in zip(REQUEST_LATENCY_BUCKETS, stats['buckets']):
+        samples.append(('_bucket', labels + [('le', bound)], count))
+      samples.append(('_bucket', labels + [('le', '+Inf')], stats['count']))
+      samples.append(('_sum', labels, stats['seconds']))
+      samples.append(('_count', labels, stats['count']))
+    add('request_seconds', 'histogram', 'Latency of HTTP requests.', samples)
+    add('request_bytes_total', 'counter', 'Bytes received in HTTP responses.',
+        [('', [('host', host), ('status', status)], stats['bytes'])
+          for (host, status), stats in sorted(self.requests.items())])
+    add('activity_seconds_total', 'counter',
+        'Time spent in SQLite and comparing images.',
+        [('', [('activity', activity)], seconds)
+          for activity, (_, seconds) in sorted(self.timers.items())])
+    add('activity_calls_total', 'counter',
+        'Number of SQLite calls and image comparisons.',
+        [('', [('activity', activity)], calls)
+          for activity, (calls, _) in sorted(self.timers.items())])
+    return '\n'.join(lines) + '\n'
+
+  def export(self):
+    '''Write the metrics to the output, if one is set. Files are replaced
+    atomically, so that they can be read while they are being updated.'''
+    if not self.output:
+      return
+    path, output_format = self.output
+    if output_format == 'prometheus':
+      text = self.to_prometheus()
+    else:
+      text = json.dumps(self.to_json(), indent=2) + '\n'
+    if path == '-':
+      sys.stdout.write(text)
+      return
+    with open(path + '.tmp', 'w') as f:
+      f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+# The metrics of this run.
+metrics = Metrics()
+
+
+class TimedCursor(sqlite3.Cursor):
+  '''A cursor that adds the time spent in SQLite to the metrics.'''
+
+  def execute(self, *args):
+    with metrics.timer('sqlite'):
+      return super().execute(*args)
+
+  def executemany(self, *args):
+    with metrics.timer('sqlite'):
+      return super().executemany(*args)
+
+  def fetchone(self):
+    with metrics.timer('sqlite'):
+      return super().fetchone()
+
+  def fetchmany(self, *args):
+    with metrics.timer('sqlite'):
+      return super().fetchmany(*args)
+
+  def fetchall(self):
+    with metrics.timer('sqlite'):
+      return super().fetchall()
+
+
+class TimedConnection(sqlite3.Connection):
+  '''A connection whose cursors are TimedCursors.'''
+
+  def cursor(self, factory=TimedCursor):
+    return super().cursor(factory)
+
+  def execute(self, *args):
+    return self.cursor().execute(*args)
+
+  def executemany(self, *args):
+    return self.cursor().executemany(*args)
+
+
+def make_session(cookies):
+  '''Create the HTTP session, with a connection pool tuned for our usage.'''
+  connector = aiohttp.TCPConnector(limit_per_host=MAX_REQUESTS_PER_HOST,
+      keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=300)
+  return aiohttp.ClientSession(cookies=cookies, connector=connector)
+
+
+def is_retryable(status):
+  '''Whether a response with the given status should be retried.'''
+  return status >= 500 or status == 429
+
+
+async def request(session, url, handle_response, **kwargs):
+  '''Make a GET request, with per-host concurrency limits and retries.
+
+  handle_response is awaited with the response, and its result is returned.
+  Timeouts, connection errors and retryable statuses are retried with
+  jittered exponential backoff; once the retries run out, the last error is
+  raised. Extra arguments are passed on to session.get().
+  '''
+  host = urllib.parse.urlsplit(url).hostname
+  semaphore = host_semaphores.setdefault(
+      host, asyncio.Semaphore(MAX_REQUESTS_PER_HOST))
+  for attempt in itertools.count():
+    try:
+      async with semaphore:
+        with metrics.request_timer(host) as timing:
+          async with session.get(url, timeout=TIMEOUT, **kwargs) as response:
+            timing.response = response
+            if is_retryable(response.status):
+              response.raise_for_status()
+            return await handle_response(response)
+    except aiohttp.ClientResponseError as e:
+      if not is_retryable(e.status) or attempt >= MAX_RETRIES:
+        raise
+    except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+        asyncio.TimeoutError):
+      if attempt >= MAX_RETRIES:
+        raise
+    # "Full jitter" backoff, so that a burst of failures doesn't turn into a
+    # burst of synchronized retries.
+    await asyncio.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def describe_error(e):
+  '''Short description of a download error, for the failure list.'''
+  if isinstance(e, asyncio.TimeoutError):
+    return 'timed out'
+  return str(e) or type(e).__name__
+
+
+async def gen_category_files(category, session, wiki_url):
+  '''Scrape the files in a category from the category's HTML pages.
+
+  Yields a list per page, of dicts with the name, url and sha1 of each file,
+  as used by update_one_category(). The HTML doesn't give us the sha1, so
+  it's None.
+  '''
   # Matches strings like:
   # <a href="/wiki/File:Clouds.png" title="File:Clouds.png">
   #  <img src="data:image/gif;base64,R0lGODlhAQABAIABAAAAAP///yH5BAEAAAEALAAAAAABAAEAQAICTAEAOw%3D%3D"
@@ -108,56 +457,143 @@ async def gen_category_files(category, session):
   #          class="category-page__pagination-next wds-button wds-is-secondary">
   next_page_re = re.compile(
     r'<a href="[^?"]+[?]from=([^"]+)"[\s]*class="category-page__pagination-next')
+  # The host is normally vignette.wikia.nocookie.net, but isn't checked, so
+  # that a local stand-in for the wiki can serve the images too.
   thumbnail_re = re.compile(
-    '(https://vignette.wikia.nocookie.net/fallenlondon/images/./../[^/]*)/.*[?]cb=([0-9]*)')
+    '(https?://[^/]*/fallenlondon/images/./../[^/]*)/.*[?]cb=([0-9]*)')
+
+  async def read_text(response):
+    response.raise_for_status()
+    return await response.text()
 
   params = {}
   category = category.replace(' ', '_')
   while True:
-    async with session.get(
-        'https://fallenlondon.fandom.com/wiki/Category:' + category,
-        params=params,
-        timeout=TIMEOUT) as response:
-      response.raise_for_status()
-      text = await response.text()
+    text = await request(session, wiki_url + '/wiki/Category:' + category,
+        read_text, params=params)
+    page = []
     for result in link_re.findall(text):
       if not result[0].startswith('File'):
         continue
       match = thumbnail_re.match(result[1])
       if not match:
         raise ValueError('Bad link: ' + result[1])
-      yield (html.unescape(result[0]), match[1] + '/revision/latest?cb=' + match[2])
+      page.append({'name': html.unescape(result[0]),
+          'url': match[1] + '/revision/latest?cb=' + match[2], 'sha1': None})
+    yield page
     next_result = next_page_re.search(text)
     if not next_result:
       break
     params['from'] = next_result.group(1)
 
 
-async def update_one_category(conn, session, category, sql):
-  '''Helper for update_categories()'''
-  print('Updating %s' % category, end='', flush=True)
-  results = []
-  async for x in gen_category_files(category, session):
-    results.append(x)
-    if len(results) % 10 == 0:
-      print('.', end='', flush=True)
-  cur = conn.executemany(sql, results)
-  print('Done!')
+async def gen_category_files_api(category, session, wiki_url):
+  '''Like gen_category_files(), but using the MediaWiki API.
+
+  This lists files in much bigger batches, and also gives us their sha1, so
+  that downloads of files we already have can be skipped.
+  '''
+  async def read_json(response):
+    response.raise_for_status()
+    return await response.json()
+
+  params = {
+    'action': 'query',
+    'format': 'json',
+    'generator': 'categorymembers',
+    'gcmtitle': 'Category:' + category,
+    'gcmtype': 'file',
+    'gcmlimit': API_BATCH_SIZE,
+    'prop': 'imageinfo',
+    'iiprop': 'sha1|timestamp|url',
+    'continue': '',
+  }
+  request_params = params
+  while True:
+    data = await request(session, wiki_url + '/api.php', read_json,
+        params=request_params)
+    if 'error' in data:
+      raise RuntimeError('API error: %s' % data['error'].get('info'))
+    files = []
+    for page in data.get('query', {}).get('pages', {}).values():
+      # Pages without imageinfo get it in a continuation response instead.
+      if not page.get('imageinfo'):
+        continue
+      info = page['imageinfo'][0]
+      # Build the same style of URL that the thumbnails give us, with the
+      # revision being the upload timestamp.
+      url = info['url'].split('?')[0]
+      if '/revision/' not in url:
+        url += '/revision/latest'
+      revision = re.sub('[^0-9]', '', info['timestamp'])
+      files.append({'name': page['title'], 'url': url + '?cb=' + revision,
+          'sha1': info['sha1']})
+    yield files
+    if 'continue' not in data:
+      break
+    # Send the original query with only the latest continuation; values from
+    # earlier ones (like a finished iicontinue) would skip results.
+    request_params = dict(params, **data['continue'])
+
+
+async def update_one_category(conn, session, category, sql, wiki_url,
+    use_api):
+  '''Helper for update_categories()
 
+  Each page of results is written with sql as soon as it's parsed, so only
+  one page is held in memory at a time.
+  '''
+  count = 0
+  gen = gen_category_files_api if use_api else gen_category_files
+  async for page in gen(category, session, wiki_url):
+    conn.executemany(sql, page)
+    count += len(page)
+    print('.', end='', flush=True)
+  return count
 
-async def update_categories(conn, session):
-  '''Update the available files and their categories by scraping the wiki.'''
+
+# Categories that set wiki_categories on the files that are in them. If a
+# file is in more than one, the last one wins.
+TAG_CATEGORIES = ['Cameo', 'Headers']
+
+
+async def update_categories(conn, session, wiki_url, use_api):
+  '''Update the available files and their categories by scraping the wiki,
+  or by querying its API if use_api is set.
+
+  All the categories are fetched at the same time.
+  '''
+  print('Updating %s' % ', '.join(['Game Files'] + TAG_CATEGORIES),
+      end='', flush=True)
+  # Files can show up in the tag categories before the Game Files listing
+  # has added them, so memberships are collected here and applied at the end.
+  conn.execute('''CREATE TEMP TABLE IF NOT EXISTS category_tags (
+      wiki_name TEXT NOT NULL,
+      category TEXT NOT NULL,
+      priority INTEGER NOT NULL
+      )''')
+  conn.execute('DELETE FROM category_tags')
   # Use "UPSERT" processing to only update the affected column when the row
   # already exists, instead of replacing the whole row (and losing the data in
-  # the other columns).
-  await update_one_category(conn, session, 'Game Files', '''INSERT INTO images
-      (wiki_name, wiki_url) VALUES (?, ?)
-      ON CONFLICT (wiki_name) DO UPDATE SET wiki_url=excluded.wiki_url''')
-  await update_one_category(conn, session, 'Cameo',
-      'UPDATE images SET wiki_categories = "Cameo" WHERE wiki_name = ? AND ? NOT NULL')
-  await update_one_category(conn, session, 'Headers',
-      'UPDATE images SET wiki_categories = "Headers" WHERE wiki_name = ? AND ? NOT NULL')
+  # the other columns). The sha1 is always replaced, so that a stale one is
+  # never trusted for a newer revision.
+  counts = await asyncio.gather(
+      update_one_category(conn, session, 'Game Files', '''INSERT INTO images
+          (wiki_name, wiki_url, wiki_sha1) VALUES (:name, :url, :sha1)
+          ON CONFLICT (wiki_name) DO UPDATE SET wiki_url=excluded.wiki_url,
+          wiki_sha1=excluded.wiki_sha1''', wiki_url, use_api),
+      *[update_one_category(conn, session, category, '''INSERT INTO
+          category_tags (wiki_name, category, priority)
+          VALUES (:name, '%s', %d)''' % (category, priority), wiki_url, use_api)
+        for priority, category in enumerate(TAG_CATEGORIES)])
+  # SQLite fills in the category from the row with the max() priority.
+  conn.execute('''UPDATE images SET wiki_categories = tags.category
+      FROM (SELECT wiki_name, category, max(priority) FROM category_tags
+        GROUP BY wiki_name) AS tags
+      WHERE images.wiki_name = tags.wiki_name''')
   conn.execute('COMMIT')
+  print('Done! (%s)' % ', '.join('%d %s' % (count, category)
+      for count, category in zip(counts, ['Game Files'] + TAG_CATEGORIES)))
 
 
 def get_group(wiki_name, categories):
@@ -177,46 +613,338 @@ def get_group(wiki_name, categories):
   return GROUP_REGULAR
 
 
-def get_state(wiki_name, wiki_image_bytes, server_image_bytes, server_status):
-  '''Get the current state of a given row.'''
-  if wiki_image_bytes == None or server_status == 0:
+def normalize_image(image):
+  '''Convert a decoded image to the RGB form that comparisons are done in.'''
+  # Extra step to eliminate warnings, but we try to avoid this most of the
+  # time because it's an expensive extra convesion.
+  if image.info.get('transparency'):
+    image = image.convert('RGBA')
+  return image.convert('RGB')
+
+
+def sum_squares_numpy(wiki_image, server_image):
+  '''Sum of squared per-channel differences, computed with numpy.'''
+  # int32 is plenty for a single squared difference (at most 3*255^2), but the
+  # total needs 64 bits for the large header images.
+  diff = (numpy.asarray(wiki_image, dtype=numpy.int32) -
+      numpy.asarray(server_image, dtype=numpy.int32))
+  return int(numpy.square(diff).sum(dtype=numpy.int64))
+
+
+def sum_squares_pillow(wiki_image, server_image):
+  '''Sum of squared per-channel differences, computed with Pillow alone.'''
+  # The histogram of the difference image has 256 buckets per channel, which is
+  # all we need to get the sum of squares without visiting each pixel in
+  # Python.
+  histogram = ImageChops.difference(wiki_image, server_image).histogram()
+  return sum(map(operator.mul, histogram, SQUARE_WEIGHTS))
+
+
+# The squared error of each bucket of an RGB difference histogram.
+SQUARE_WEIGHTS = [(i % 256) ** 2 for i in range(3 * 256)]
+
+
+sum_squares = sum_squares_numpy if numpy else sum_squares_pillow
+
+
+def get_quick_state(wiki_hash, server_hash, server_status, wiki_pixels=None,
+    server_pixels=None):
+  '''Get the state of a row if it can be told without loading the images,
+  otherwise None. wiki_pixels and server_pixels are the stored pixel hashes of
+  the images, if known.'''
+  if wiki_hash == None or server_status == 0:
     return STATE_UNFETCHED
-  if server_image_bytes == None:
+  if server_hash == None:
     return STATE_CANT_FETCH
-  # We do the rest of these checks from cheapest to more expensive
-  if wiki_image_bytes == server_image_bytes:
+  if wiki_hash == server_hash:
     return STATE_SAME_FILE
-  with Image.open(io.BytesIO(wiki_image_bytes)) as wiki_image:
-    with Image.open(io.BytesIO(server_image_bytes)) as server_image:
-      if wiki_image.size != server_image.size:
-        return STATE_SIZE_MISMATCH
-      # Extra step to eliminate warnings, but we try to avoid this most of the
-      # time because it's an expensive extra convesion.
-      if wiki_image.info.get('transparency'):
-        wiki_image = wiki_image.convert('RGBA')
-      if server_image.info.get('transparency'):
-        server_image = server_image.convert('RGBA')
-
-      diff = ImageChops.difference(
-          wiki_image.convert('RGB'), server_image.convert('RGB'))
-      sum_sq = sum(r*r + g*g + b*b for r,g,b in diff.getdata())
-      if sum_sq == 0:
-        return STATE_SAME_PIXELS
-      # This is a very simple sum-of-squares threshold test, no accounting for
-      # perceptual modeling. The threshold was chosen by examining various
-      # images - PNG quantisization artifacts result in an error that's almost
-      # always <100. "Real" differences where the images a similar, but
-      # obivously different (tinted differently, shifted, etc.) have an error
-      # >500. Errors >50 are usually visible, even with an algorithm
-      # attempting to distribute the noise.
-      error = float(sum_sq) / (wiki_image.width * wiki_image.height)
-      if error < 50.0:
-        #print(wiki_name, ratio)
-        return STATE_SIMILAR
+  if wiki_pixels and wiki_pixels == server_pixels:
+    return STATE_SAME_PIXELS
+  return None
+
+
+def get_pixel_hash(image_bytes):
+  '''Get a hash of the pixels of an image, in the normalized form that
+  get_state() compares, or None if the image can't be decoded.
+
+  Two images have the same pixel hash exactly when get_state() would find
+  them to be the same size with no error, i.e. SAME_PIXELS.
+  '''
+  try:
+    with Image.open(io.BytesIO(image_bytes)) as image:
+      image = normalize_image(image)
+  except (OSError, ValueError):
+    return None
+  hasher = hashlib.sha256(b'%dx%d:' % image.size)
+  hasher.update(image.tobytes())
+  return hasher.hexdigest()
+
+
+def get_png_size(image_bytes):
+  '''Read the (width, height) of a PNG from its header, without decoding it.
+  Returns None for anything that isn't a PNG.'''
+  if (image_bytes[:8] != b'\x89PNG\r\n\x1a\n' or
+      image_bytes[12:16] != b'IHDR'):
+    return None
+  return struct.unpack('>II', image_bytes[16:24])
+
+
+def get_thumbnail_bound(wiki_image, server_image):
+  '''Get a lower bound on the sum of squares error of two normalized,
+  same-sized images, by comparing thumbnails of them.
+
+  Each thumbnail pixel is the mean of a block of pixels, rounded, so it's
+  within 0.5 of the true mean. The squared errors of the pixels in a block
+  add up to at least the block size times the square of the difference of
+  the means, so that (less 1 for the rounding) gives the bound.
+  '''
+  factor = THUMBNAIL_FACTOR
+  # Only whole blocks are compared; leaving out the rest still gives a bound.
+  box = (0, 0, wiki_image.width - wiki_image.width % factor,
+      wiki_image.height - wiki_image.height % factor)
+  if not box[2] or not box[3]:
+    return 0
+  histogram = ImageChops.difference(wiki_image.reduce(factor, box),
+      server_image.reduce(factor, box)).histogram()
+  return factor * factor * sum(map(operator.mul, histogram, THUMBNAIL_WEIGHTS))
+
+
+# The squared error that each bucket of a thumbnail difference histogram
+# contributes to get_thumbnail_bound().
+THUMBNAIL_WEIGHTS = [max(0, i % 256 - 1) ** 2 for i in range(3 * 256)]
+
+
+def get_state(wiki_name, wiki_image_bytes, server_image_bytes,
+    sum_squares_fn=None, timings=None):
+  '''Get the state of a pair of images that get_quick_state() couldn't
+  classify.
+
+  If timings (a Metrics) is given, the time spent decoding and comparing the
+  images is added to it.
+  '''
+  if timings is None:
+    timings = Metrics()
+  # We do these checks from cheapest to more expensive, starting with the
+  # sizes in the PNG headers.
+  wiki_size = get_png_size(wiki_image_bytes)
+  server_size = get_png_size(server_image_bytes)
+  if wiki_size and server_size and wiki_size != server_size:
+    return STATE_SIZE_MISMATCH
+  with timings.timer('get_state_decode'):
+    with Image.open(io.BytesIO(wiki_image_bytes)) as wiki_image:
+      with Image.open(io.BytesIO(server_image_bytes)) as server_image:
+        if wiki_image.size != server_image.size:
+          return STATE_SIZE_MISMATCH
+        wiki_image = normalize_image(wiki_image)
+        server_image = normalize_image(server_image)
+  with timings.timer('get_state_diff'):
+    return compare_images(wiki_image, server_image,
+        sum_squares_fn or sum_squares)
+
+
+def compare_images(wiki_image, server_image, sum_squares_fn):
+  '''Helper for get_state(), for normalized images of the same size.'''
+  width, height = wiki_image.size
+  # The error only grows as more of the images are compared, so once it's at
+  # the limit, the pair is TOO_DIFFERENT no matter what the rest looks like.
+  limit = SIMILAR_MAX_ERROR * width * height
+  # Small images are compared in one go, since that's as cheap as any of the
+  # shortcuts.
+  strip_rows = max(1, COMPARE_STRIP_PIXELS // width)
+  if height <= strip_rows:
+    return state_from_error(
+        sum_squares_fn(wiki_image, server_image), width * height)
+  if get_thumbnail_bound(wiki_image, server_image) >= limit:
+    return STATE_TOO_DIFFERENT
+  sum_sq = 0
+  for top in range(0, height, strip_rows):
+    box = (0, top, width, min(top + strip_rows, height))
+    sum_sq += sum_squares_fn(wiki_image.crop(box), server_image.crop(box))
+    if sum_sq >= limit:
       return STATE_TOO_DIFFERENT
+  return state_from_error(sum_sq, width * height)
+
+
+def state_from_error(sum_sq, pixels):
+  '''Classify a same-sized pair of images by their sum-of-squares error.'''
+  if sum_sq == 0:
+    return STATE_SAME_PIXELS
+  # This is a very simple sum-of-squares threshold test, no accounting for
+  # perceptual modeling. The threshold was chosen by examining various
+  # images - PNG quantisization artifacts result in an error that's almost
+  # always <100. "Real" differences where the images a similar, but
+  # obivously different (tinted differently, shifted, etc.) have an error
+  # >500. Errors >50 are usually visible, even with an algorithm
+  # attempting to distribute the noise.
+  error = float(sum_sq) / pixels
+  if error < SIMILAR_MAX_ERROR:
+    return STATE_SIMILAR
+  return STATE_TOO_DIFFERENT
+
+
+def check_compare(conn):
+  '''Classify every stored pair with both comparison engines, and report any
+  disagreements.'''
+  if not numpy:
+    raise RuntimeError('--check-compare needs numpy to be installed')
+  print('Comparing engines', end='', flush=True)
+  cur = conn.execute('''SELECT wiki_name, wiki_hash, server_hash,
+      server_status FROM images''')
+  checked = 0
+  mismatches = []
+  while result := cur.fetchmany(50):
+    for wiki_name, wiki_hash, server_hash, server_status in result:
+      if get_quick_state(wiki_hash, server_hash, server_status):
+        continue
+      wiki_image = load_blob(conn, wiki_hash)
+      server_image = load_blob(conn, server_hash)
+      numpy_state = get_state(wiki_name, wiki_image, server_image,
+          sum_squares_numpy)
+      pillow_state = get_state(wiki_name, wiki_image, server_image,
+          sum_squares_pillow)
+      if numpy_state != pillow_state:
+        mismatches.append((wiki_name, numpy_state, pillow_state))
+      checked += 1
+      if checked % 10 == 0:
+        print('.', end='', flush=True)
+  print(' %d image pairs checked, %d mismatches' % (checked, len(mismatches)))
+  for wiki_name, numpy_state, pillow_state in mismatches:
+    print('%s: numpy says %s, Pillow says %s' % (
+        wiki_name, numpy_state, pillow_state))
+  return not mismatches
+
+
+def get_dhash(image_bytes):
+  '''Compute the 64-bit difference hash ("dHash") of an image.
+
+  This is a perceptual hash: it only changes a little when the image is
+  resized, recompressed or slightly altered, so similar images have hashes
+  that are a small Hamming distance apart. Returns None if the image can't
+  be decoded.
+  '''
+  try:
+    with Image.open(io.BytesIO(image_bytes)) as image:
+      small = normalize_image(image).convert('L').resize((9, 8), Image.LANCZOS)
+  except (OSError, ValueError):
+    return None
+  pixels = small.tobytes()
+  dhash = 0
+  for row in range(8):
+    for col in range(8):
+      left = pixels[row * 9 + col]
+      dhash = (dhash << 1) | (left > pixels[row * 9 + col + 1])
+  return dhash
+
+
+def hamming_distance(a, b):
+  '''Number of bits that differ between two hashes.'''
+  return bin(a ^ b).count('1')
+
+
+class BKTree:
+  '''A BK-tree of 64-bit hashes, for finding the hashes within a Hamming
+  distance of a query without comparing it against every one.'''
+
+  def __init__(self):
+    # Each node is [hash, values, {distance: child node}].
+    self.root = None
 
+  def add(self, key, value):
+    if self.root is None:
+      self.root = [key, [value], {}]
+      return
+    node = self.root
+    while True:
+      distance = hamming_distance(key, node[0])
+      if distance == 0:
+        node[1].append(value)
+        return
+      child = node[2].get(distance)
+      if child is None:
+        node[2][distance] = [key, [value], {}]
+        return
+      node = child
 
-def map_helper(subdir, trim_list, wiki_name):
+  def search(self, key, max_distance):
+    '''Return (distance, value) for everything within max_distance of key.'''
+    results = []
+    stack = [self.root] if self.root else []
+    while stack:
+      node_key, values, children = stack.pop()
+      distance = hamming_distance(key, node_key)
+      if distance <= max_distance:
+        results.extend((distance, value) for value in values)
+      # By the triangle inequality, only children whose distance from this
+      # node is within max_distance of ours can have matches.
+      for child_distance, child in children.items():
+        if abs(child_distance - distance) <= max_distance:
+          stack.append(child)
+    return sorted(results)
+
+
+def load_dhash(conn, blob_hash):
+  '''Get the dHash of a stored image, computing and storing it the first
+  time it's needed. Returns None if the image can't be decoded.'''
+  dhash, = conn.execute(
+      'SELECT dhash FROM blobs WHERE hash = ?', [blob_hash]).fetchone()
+  if dhash is None:
+    dhash = get_dhash(load_blob(conn, blob_hash))
+    # An empty string records that the blob can't be decoded (like an error
+    # page served with an image URL), so it isn't retried on every run.
+    dhash = '' if dhash is None else '%016x' % dhash
+    conn.execute(
+        'UPDATE blobs SET dhash = ? WHERE hash = ?', [dhash, blob_hash])
+  return int(dhash, 16) if dhash else None
+
+
+def find_renames(conn):
+  '''Suggest server URLs for images that we couldn't fetch, by looking for
+  server images that look like the wiki image.
+
+  The most common reason for a fetch to fail is that the file was renamed on
+  the server (or map_helper() guessed wrong), so a perceptually similar image
+  that we did fetch for some other row is a good candidate.
+  '''
+  print('Indexing server images', end='', flush=True)
+  tree = BKTree()
+  cur = conn.execute('''SELECT wiki_name, server_url, server_hash FROM images
+      WHERE server_hash NOT NULL''')
+  count = 0
+  while result := cur.fetchmany(50):
+    for wiki_name, server_url, server_hash in result:
+      dhash = load_dhash(conn, server_hash)
+      if dhash is None:
+        continue
+      tree.add(dhash, (server_url, wiki_name))
+      count += 1
+      if count % 10 == 0:
+        print('.', end='', flush=True)
+  print(' %d images' % count)
+
+  cur = conn.execute('''SELECT wiki_name, wiki_hash, server_url FROM images
+      WHERE server_hash IS NULL AND server_status != 0 AND wiki_hash NOT NULL
+      ORDER BY wiki_name''')
+  suggestions = 0
+  orphans = cur.fetchall()
+  for wiki_name, wiki_hash, server_url in orphans:
+    dhash = load_dhash(conn, wiki_hash)
+    if dhash is None:
+      continue
+    matches = tree.search(dhash, RENAME_MAX_DISTANCE)
+    if not matches:
+      continue
+    suggestions += 1
+    print('%s (currently %s) looks like:' % (wiki_name, server_url))
+    for distance, (url, other_name) in matches[:RENAME_MAX_SUGGESTIONS]:
+      print('  %s (distance %d, fetched for %s)' % (url, distance, other_name))
+  # Save any newly computed dHashes.
+  if conn.in_transaction:
+    conn.execute('COMMIT')
+  print('\n%d suggestions for %d images that couldn\'t be fetched' % (
+      suggestions, len(orphans)))
+
+
+def map_helper(subdir, trim_list, wiki_name, server_url=SERVER_URL):
   '''Helper used by update_map() to construct URLs.'''
   # Patch in from the special rename list, if there's one available.
   wiki_name = RENAMES.get(wiki_name, wiki_name)
@@ -229,28 +957,41 @@ def map_helper(subdir, trim_list, wiki_name):
   wiki_name = wiki_name.replace(' ', '_')
   # Only lowercase *first* letter
   wiki_name = wiki_name[:1].lower() + wiki_name[1:]
-  return 'https://images.fallenlondon.com/images/%s/%s.png' % (
-      subdir, wiki_name)
+  return '%s/images/%s/%s.png' % (server_url, subdir, wiki_name)
 
 
-def update_map(conn, overwrite):
-  '''Map all wiki filenames to server URLs.'''
+# The (subdir, trim_list) that map_helper() is called with for each group.
+# Groups that aren't listed have no sensible server URL.
+MAP_ARGS = {
+  GROUP_HEADER: ('headers', ['-header', ' header', 'header']),
+  GROUP_CAMEO: ('cameos', ['cameo']),
+  GROUP_SMALL: ('icons_small', ['small']),
+  GROUP_REGULAR: ('icons', []),
+}
+
+
+def update_map(conn, overwrite, server_url=SERVER_URL):
+  '''Map wiki filenames to server URLs, on the server at server_url.
+
+  Only rows that are new, or whose categories have changed, since they were
+  last mapped are looked at, along with rows whose last fetch failed (so that
+  fixes to RENAMES or MAP_ARGS reach them), unless overwrite is set, in which
+  case every row is.
+  '''
   print('Updating server URL mappings... ', end='', flush=True)
-  cur = conn.execute(
-      'SELECT wiki_name, wiki_categories, server_url, server_status FROM images')
+  cur = conn.execute('''SELECT wiki_name, wiki_categories, server_url,
+      server_status FROM images''' + ('' if overwrite else
+          ' WHERE NOT mapped OR server_status >= 400'))
   unchanged = 0
-  changed = 0
-  while result := cur.fetchmany(50):
+  changed = []
+  mapped = []
+  while result := cur.fetchmany(500):
     for wiki_name, categories, url, status in result:
-      mapped_url = {
-        GROUP_NON_PNG: lambda x: '',
-        GROUP_SML: lambda x: '',
-        GROUP_HEADER: lambda x: map_helper(
-            'headers', ['-header', ' header', 'header'], x),
-        GROUP_CAMEO: lambda x: map_helper('cameos', ['cameo'], x),
-        GROUP_SMALL: lambda x: map_helper('icons_small', ['small'], x),
-        GROUP_REGULAR: lambda x: map_helper('icons', [], x),
-      }[get_group(wiki_name, categories)](wiki_name)
+      group = get_group(wiki_name, categories)
+      mapped.append([group, wiki_name])
+      mapped_url = ''
+      if group in MAP_ARGS:
+        mapped_url = map_helper(*MAP_ARGS[group], wiki_name, server_url)
       # Don't update if we can't generate a sensible URL, don't update if it's
       # the same URL, otherwise we'll only update if either overwrite or
       # the previous fetch was in error. The last behavior is to allow for
@@ -259,107 +1000,393 @@ def update_map(conn, overwrite):
           status != 0 and status < 400 and not overwrite):
         unchanged += 1
         continue
-      changed += 1
-      # Update metadata to force a subsequent fetch as well
-      conn.execute('''UPDATE images SET server_url = ?, server_image = NULL,
-          server_etag = '', server_last_modified = '', server_fetched_at = ''
-          WHERE wiki_name = ?''',
-          [mapped_url, wiki_name])
-  if changed:
+      changed.append([mapped_url, wiki_name])
+  # Update metadata to force a subsequent fetch as well
+  conn.executemany('''UPDATE images SET server_url = ?, server_hash = NULL,
+      server_etag = '', server_last_modified = '', server_fetched_at = ''
+      WHERE wiki_name = ?''', changed)
+  conn.executemany('''UPDATE images SET wiki_group = ?, mapped = 1
+      WHERE wiki_name = ?''', mapped)
+  if conn.in_transaction:
+    conn.execute('COMMIT')
+  print('%d changed URLs and %d unchanged' % (len(changed), unchanged))
+
+
+def get_blob_hash(data):
+  '''Get the key that data is stored under in the blobs table.'''
+  return hashlib.sha256(data).hexdigest()
+
+
+def get_sha1(data):
+  '''Get the SHA-1 of data, as the wiki reports it for its files.'''
+  return hashlib.sha1(data).hexdigest()
+
+
+async def store_blob(conn, blob_hash, data):
+  '''Get the (sql, params) statement that stores data in the blobs table.
+
+  If the blob is new, its pixel hash is computed for it, on a worker thread so
+  that decoding the image doesn't hold up the event loop.
+  '''
+  pixel_hash = None
+  if not conn.execute(
+      'SELECT 1 FROM blobs WHERE hash = ?', [blob_hash]).fetchone():
+    pixel_hash = await asyncio.get_running_loop().run_in_executor(
+        None, get_pixel_hash, data)
+  return ('''INSERT OR IGNORE INTO blobs (hash, sha1, pixel_hash, data)
+      VALUES (?, ?, ?, ?)''', [blob_hash, get_sha1(data), pixel_hash, data])
+
+
+def load_pixel_hash(conn, blob_hash):
+  '''Get the stored pixel hash of a blob, or None if it doesn't have one.'''
+  row = conn.execute(
+      'SELECT pixel_hash FROM blobs WHERE hash = ?', [blob_hash]).fetchone()
+  return row and row[0]
+
+
+def load_blob(conn, blob_hash):
+  '''Load the data with the given hash from the blobs table.'''
+  return conn.execute(
+      'SELECT data FROM blobs WHERE hash = ?', [blob_hash]).fetchone()[0]
+
+
+def delete_unused_blobs(conn):
+  '''Delete blobs that are no longer referenced by any image.'''
+  cur = conn.execute('''DELETE FROM blobs WHERE hash NOT IN (
+      SELECT wiki_hash FROM images WHERE wiki_hash NOT NULL UNION
+      SELECT server_hash FROM images WHERE server_hash NOT NULL)''')
+  if cur.rowcount:
     conn.execute('COMMIT')
-  print('%d changed URLs and %d unchanged' % (changed, unchanged))
+  return cur.rowcount
+
+
+async def db_writer(conn, queue, on_failure):
+  '''Execute (statements, size) items from the queue, committing at
+  checkpoints. Each item is a list of (sql, params) statements that belong
+  together, and the size of the image data in them. A None item ends the
+  writer, after a final commit.
+
+  If a write fails before the end, on_failure() is called, and the rest of
+  the queue is drained (without writing it) up to the None item, so that
+  nothing is left blocked on a full queue. Then the exception is raised.
+  '''
+  rows = 0
+  size = 0
+  ended = False
+  try:
+    while True:
+      try:
+        item = await asyncio.wait_for(queue.get(), CHECKPOINT_SECONDS)
+      except asyncio.TimeoutError:
+        # Things are quiet, so don't leave the last few rows uncommitted.
+        if rows:
+          conn.execute('COMMIT')
+          rows = 0
+          size = 0
+        continue
+      if item is None:
+        ended = True
+        break
+      statements, item_size = item
+      for sql, params in statements:
+        conn.execute(sql, params)
+      rows += 1
+      size += item_size
+      if rows >= CHECKPOINT_ROWS or size >= CHECKPOINT_BYTES:
+        conn.execute('COMMIT')
+        rows = 0
+        size = 0
+    if rows:
+      conn.execute('COMMIT')
+  except Exception:
+    if not ended:
+      on_failure()
+      while await queue.get() is not None:
+        pass
+    raise
+
+
+@contextlib.asynccontextmanager
+async def checkpointed_writes(conn):
+  '''Run a db_writer() task for the duration of the context, yielding the
+  queue that feeds it.
+
+  If the writer fails, the task running the context is cancelled, so that it
+  doesn't carry on (or wait forever) with nothing being written, and the
+  writer's exception is raised from the context instead.
+  '''
+  queue = asyncio.Queue(WRITE_QUEUE_SIZE)
+  writer = asyncio.create_task(
+      db_writer(conn, queue, asyncio.current_task().cancel))
+  try:
+    yield queue
+  finally:
+    # Even when something failed, flush everything that made it into the
+    # queue, so that a rerun can pick up from there.
+    if not writer.done():
+      await queue.put(None)
+    await writer
+
+
+async def classify_fetched(conn, executor, fetched_queue, write_queue):
+  '''Classify rows as their server images are fetched, queueing the new
+  states to be written to the DB.
+
+  Items from fetched_queue are (wiki_name, server_status, server_hash, image)
+  for each completed fetch, where server_hash and image are None for a 304.
+  The image comparisons are run on executor. A None item ends the
+  classifier.
+  '''
+  while (item := await fetched_queue.get()) is not None:
+    try:
+      await classify_fetched_row(conn, executor, write_queue, *item)
+    except Exception as e:
+      # Keep consuming, or the downloads would block on a full queue. The
+      # row's state stays stale, so update_states() will classify it later.
+      print('Failed to classify %s: %r' % (item[0], e), file=sys.stderr)
+
+
+async def classify_fetched_row(conn, executor, write_queue, wiki_name,
+    server_status, server_hash, image):
+  '''Helper for classify_fetched(), handling a single fetched row.'''
+  wiki_hash, old_server_hash, state_key = conn.execute(
+      '''SELECT wiki_hash, server_hash, state_key FROM images
+      WHERE wiki_name = ?''', [wiki_name]).fetchone()
+  if server_status == 304:
+    server_hash = old_server_hash
+  new_key = get_state_key(wiki_hash, server_hash, server_status)
+  if new_key == state_key:
+    return
+  # A newly fetched blob may still be waiting in the write queue, in which
+  # case its pixel hash isn't known here, and the images are compared instead.
+  state = get_quick_state(wiki_hash, server_hash, server_status,
+      load_pixel_hash(conn, wiki_hash), load_pixel_hash(conn, server_hash))
+  if not state:
+    (state,), timers = await asyncio.get_running_loop().run_in_executor(
+        executor, classify_batch, [(wiki_name, load_blob(conn, wiki_hash),
+            image or load_blob(conn, server_hash))])
+    metrics.merge_timers(timers)
+  await write_queue.put(([(
+      'UPDATE images SET state = ?, state_key = ? WHERE wiki_name = ?',
+      [state, new_key, wiki_name])], 0))
+
+
+@contextlib.asynccontextmanager
+async def pipelined_classification(conn, executor, jobs, write_queue):
+  '''Run classify_fetched() tasks for the duration of the context, yielding
+  the queue that feeds them, or None if there is no executor.'''
+  if not executor:
+    yield None
+    return
+  fetched_queue = asyncio.Queue(WRITE_QUEUE_SIZE)
+  # Twice as many classifiers as workers, so the workers don't sit idle while
+  # a classifier is waiting on the DB or the queue.
+  classifiers = [asyncio.create_task(
+      classify_fetched(conn, executor, fetched_queue, write_queue))
+      for _ in range(2 * jobs)]
+  try:
+    yield fetched_queue
+  finally:
+    for classifier in classifiers:
+      if not classifier.done():
+        await fetched_queue.put(None)
+    await asyncio.gather(*classifiers)
+
+
+def print_failures(failures):
+  '''Print the (wiki_name, error) pairs of downloads that failed.'''
+  for wiki_name, error in failures:
+    print('Failed to download %s: %s' % (wiki_name, error), file=sys.stderr)
 
 
 async def do_download_wiki(conn, session):
   # Use count() for thread-safety; the Global Interpreter Lock means two
   # threads can't interleave increments.
   counter = itertools.count(start=1)
+  unmodified = itertools.count()
+  failures = []
+
+  async def read_image(response):
+    if response.status != 304:
+      response.raise_for_status()
+    return (response.status, await response.read(),
+        response.request_info.url.query['cb'],
+        response.headers.get('ETag', ''),
+        response.headers.get('Last-Modified', ''))
 
-  async def fetch(wiki_name, wiki_url):
-    async with session.get(wiki_url, timeout=TIMEOUT) as response:
-      response.raise_for_status();
-      image = await response.read()
-      new_revision = response.request_info.url.query['cb']
-    conn.execute('''UPDATE images SET wiki_revision = ?, wiki_image = ?
-        WHERE wiki_name = ?''', [new_revision, image, wiki_name])
+  async def fetch(queue, wiki_name, wiki_url, wiki_hash, wiki_etag,
+      wiki_last_modified):
+    # A new revision often has the same file (e.g. after a purge), so when we
+    # have the file already, only ask for it if it has changed.
+    headers = {}
+    if wiki_hash and wiki_etag:
+      headers['If-None-Match'] = wiki_etag
+    if wiki_hash and wiki_last_modified:
+      headers['If-Modified-Since'] = wiki_last_modified
+    try:
+      status, image, new_revision, etag, last_modified = await request(
+          session, wiki_url, read_image, headers=headers)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      # Leave the row alone, so that it's retried next time.
+      failures.append((wiki_name, describe_error(e)))
+      return
+    if status == 304:
+      next(unmodified)
+      # A 304 doesn't have to repeat the validators.
+      await queue.put(([('''UPDATE images SET wiki_revision = ?,
+          wiki_etag = ?, wiki_last_modified = ? WHERE wiki_name = ?''',
+          [new_revision, etag or wiki_etag,
+            last_modified or wiki_last_modified, wiki_name])], 0))
+    else:
+      image_hash = get_blob_hash(image)
+      await queue.put(([await store_blob(conn, image_hash, image),
+          ('''UPDATE images SET wiki_revision = ?, wiki_hash = ?,
+          wiki_etag = ?, wiki_last_modified = ? WHERE wiki_name = ?''',
+          [new_revision, image_hash, etag, last_modified, wiki_name])],
+          len(image)))
     count = next(counter)
     if count % 10 == 0:
       print('.', end='', flush=True)
 
-  coros = []
-  cur = conn.execute(
-      'SELECT wiki_name, wiki_url, wiki_revision FROM images')
+  rows = []
+  stored = []
+  cur = conn.execute('''SELECT wiki_name, wiki_url, wiki_revision, wiki_sha1,
+      wiki_hash, wiki_etag, wiki_last_modified FROM images''')
   print('Downloading', end='', flush=True)
 
   rowcount = 0
   while result := cur.fetchmany(50):
-    for wiki_name, wiki_url, wiki_revision in result:
+    for (wiki_name, wiki_url, wiki_revision, wiki_sha1, wiki_hash, wiki_etag,
+        wiki_last_modified) in result:
       rowcount += 1
       if not wiki_url[-18:-14] == '?cb=':
         raise RuntimeError('URL lacks revision: ' + wiki_url)
       if wiki_url[-14:] == wiki_revision:
         continue
-      coros.append(fetch(wiki_name, wiki_url))
-  print(' %d wiki images, %d up-to-date' % (len(coros), rowcount - len(coros)),
+      # If the wiki told us the file's sha1, and we already have a file with
+      # that sha1 (often the server image), there's no need to download it.
+      blob = wiki_sha1 and conn.execute(
+          'SELECT hash FROM blobs WHERE sha1 = ?', [wiki_sha1]).fetchone()
+      if blob:
+        stored.append([wiki_url[-14:], blob[0], wiki_name])
+        continue
+      rows.append((wiki_name, wiki_url, wiki_hash, wiki_etag,
+          wiki_last_modified))
+  print(' %d wiki images, %d up-to-date, %d already stored' % (
+      len(rows), rowcount - len(rows) - len(stored), len(stored)),
       end='', flush=True)
-  await asyncio.gather(*coros)
-  if len(coros):
+  if stored:
+    # The validators were for the old file, which this may not be.
+    conn.executemany('''UPDATE images SET wiki_revision = ?, wiki_hash = ?,
+        wiki_etag = '', wiki_last_modified = '' WHERE wiki_name = ?''',
+        stored)
     conn.execute('COMMIT')
-  print()
+  async with checkpointed_writes(conn) as queue:
+    await asyncio.gather(*(fetch(queue, *row) for row in rows))
+  print(' %d unmodified' % next(unmodified))
+  print_failures(failures)
+
+
+def get_expiry(server_fetched_at, server_max_age, server_age):
+  '''Get the time a server image expires, from its stored headers, or None
+  if it has no max-age.'''
+  if not (server_fetched_at and server_max_age):
+    return None
+  return datetime.fromisoformat(server_fetched_at) + timedelta(
+      seconds=int(server_max_age) - int(server_age or '0'))
+
+
+async def fetch_server_image(conn, session, queue, fetched_queue, wiki_name,
+    server_url, server_etag, server_last_modified):
+  '''Conditionally fetch a server image, queueing the result to be written
+  to the DB (and classified, if there's a fetched_queue).
+
+  Returns the response status and the new expiry time (as for get_expiry()).
+  Transient failures are raised, without anything being queued.
+  '''
+  max_age_re = re.compile('max-age=([0-9]*)')
+
+  async def read_response(response):
+    etag = response.headers.get('ETag', '')
+    status = response.status
+    last_modified = response.headers.get('Last-Modified', '')
+    age = response.headers.get('Age', '')
+    match = max_age_re.search(response.headers.get('Cache-Control', ''))
+    if match:
+      max_age = match.group(1)
+    else:
+      max_age = ''
+    fetched_at = datetime.now(timezone.utc).isoformat()
+    image = await response.read()
+    return status, etag, last_modified, age, max_age, fetched_at, image
+
+  headers = {}
+  if server_etag:
+    headers['If-None-Match'] = server_etag
+  if server_last_modified:
+    headers['If-Modified-Since'] = server_last_modified
+  (status, etag, last_modified, age, max_age, fetched_at,
+      image) = await request(session, server_url, read_response,
+          headers=headers)
+  if status == 304:
+    # Don't overwrite the existing image, but update the other header
+    # information.
+    await queue.put(([('''UPDATE images SET server_status = ?,
+        server_etag = ?, server_last_modified = ?, server_age = ?,
+        server_max_age = ?, server_fetched_at = ? WHERE wiki_name = ?''',
+        [status, etag, last_modified, age, max_age, fetched_at, wiki_name])],
+        0))
+    image = None
+    image_hash = None
+  else:
+    # Update image, even if it's an error. If it's an error, clear out the
+    # image first. (The body is probably an error page.)
+    statements = []
+    if status >= 400:
+      image = b''
+      image_hash = None
+    else:
+      image_hash = get_blob_hash(image)
+      statements.append(await store_blob(conn, image_hash, image))
+    statements.append(('''UPDATE images SET server_status = ?,
+        server_etag = ?, server_last_modified = ?, server_age = ?,
+        server_max_age = ?, server_fetched_at = ?, server_hash = ?
+        WHERE wiki_name = ?''',
+        [status, etag, last_modified, age, max_age, fetched_at,
+          image_hash, wiki_name]))
+    await queue.put((statements, len(image)))
+  if fetched_queue:
+    await fetched_queue.put((wiki_name, status, image_hash, image))
+  return status, get_expiry(fetched_at, max_age, age)
 
 
-async def do_download_server(conn, session, force_reload):
+async def do_download_server(conn, session, force_reload, executor=None,
+    jobs=1):
   # Use count() for thread-safety; the Global Interpreter Lock means two
   # threads can't interleave increments.
   counter = itertools.count(start=1)
   fetched = itertools.count()
   errors = itertools.count()
-  max_age_re = re.compile('max-age=([0-9]*)')
+  failures = []
 
-  async def fetch(wiki_name, server_url, server_etag, server_last_modified):
-    headers = {}
-    if server_etag:
-      headers['If-None-Match'] = server_etag
-    if server_last_modified:
-      headers['If-Modified-Since'] = server_last_modified
-    async with session.get(
-        server_url, headers=headers, timeout=TIMEOUT) as response:
-      etag = response.headers.get('ETag', '')
-      status = response.status
-      last_modified = response.headers.get('Last-Modified', '')
-      age = response.headers.get('Age', '')
-      match = max_age_re.search(response.headers.get('Cache-Control', ''))
-      if match:
-        max_age = match.group(1)
-      else:
-        max_age = ''
-      fetched_at = datetime.now(timezone.utc).isoformat()
-      image = await response.read()
-    if status == 304:
-      # Don't overwrite the existing image, but update the other header
-      # information.
-      conn.execute('''UPDATE images SET server_status = ?, server_etag = ?,
-          server_last_modified = ?, server_age = ?, server_max_age = ?,
-          server_fetched_at = ? WHERE wiki_name = ?''',
-          [status, etag, last_modified, age, max_age, fetched_at, wiki_name])
-    else:
-      # Update image, even if it's an error. If it's an error, clear out the
-      # image first. (The body is probably an error page.)
-      if status >= 400:
-        next(errors)
-        image = None
-      else:
-        next(fetched)
-      conn.execute('''UPDATE images SET server_status = ?, server_etag = ?,
-          server_last_modified = ?, server_age = ?, server_max_age = ?,
-          server_fetched_at = ?, server_image = ? WHERE wiki_name = ?''',
-          [status, etag, last_modified, age, max_age, fetched_at,
-            image, wiki_name])
+  async def fetch(queue, fetched_queue, wiki_name, *args):
+    try:
+      status, _ = await fetch_server_image(
+          conn, session, queue, fetched_queue, wiki_name, *args)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      # Transient failures (as opposed to 4xx errors, which are recorded)
+      # leave the row alone, so that it's retried next time.
+      failures.append((wiki_name, describe_error(e)))
+      return
+    if status >= 400:
+      next(errors)
+    elif status != 304:
+      next(fetched)
     count = next(counter)
     if count % 10 == 0:
       print('.', end='', flush=True)
 
-  coros = []
+  rows = []
   cur = conn.execute(
       '''SELECT wiki_name, server_url, server_status, server_etag,
       server_last_modified, server_age, server_max_age,
@@ -368,6 +1395,7 @@ async def do_download_server(conn, session, force_reload):
 
   cached = 0
   invalid = 0
+  now = datetime.now(tz=timezone.utc)
   while result := cur.fetchmany(50):
     for (wiki_name, server_url, server_status, server_etag,
         server_last_modified, server_age, server_max_age,
@@ -375,95 +1403,349 @@ async def do_download_server(conn, session, force_reload):
       if not server_url:
         invalid += 1
         continue
-      if server_fetched_at and server_max_age:
-        ttl = (datetime.fromisoformat(server_fetched_at) -
-            datetime.now(tz=timezone.utc)) + timedelta(seconds=(
-                int(server_max_age) - int(server_age or '0')))
-      else:
-        ttl = timedelta()
-      if ttl > timedelta() and not force_reload:
+      expiry = get_expiry(server_fetched_at, server_max_age, server_age)
+      if expiry and expiry > now and not force_reload:
         cached += 1
         continue
-      coros.append(fetch(wiki_name, server_url, server_etag, server_last_modified))
-  print(' %d server images, %d cached, %d invalid' % (len(coros), cached, invalid),
+      rows.append((wiki_name, server_url, server_etag, server_last_modified))
+  print(' %d server images, %d cached, %d invalid' % (len(rows), cached, invalid),
       end='', flush=True)
-  await asyncio.gather(*coros)
-  if len(coros):
-    conn.execute('COMMIT')
+  async with checkpointed_writes(conn) as queue:
+    async with pipelined_classification(
+        conn, executor, jobs, queue) as fetched_queue:
+      await asyncio.gather(*(fetch(queue, fetched_queue, *row) for row in rows))
   fetched_count = next(fetched)
   errors_count = next(errors)
-  print('\nDownloaded %d, %d errors, %d unmodified\n' % (
-    fetched_count, errors_count, len(coros) - fetched_count - errors_count))
+  print('\nDownloaded %d, %d errors, %d unmodified, %d failed\n' % (
+    fetched_count, errors_count,
+    len(rows) - fetched_count - errors_count - len(failures), len(failures)))
+  print_failures(failures)
+
+
+def make_executor(jobs):
+  '''Create the executor that images are classified on while downloading.'''
+  if jobs > 1:
+    return concurrent.futures.ProcessPoolExecutor(jobs)
+  # A thread still keeps the comparisons off of the event loop.
+  return concurrent.futures.ThreadPoolExecutor(1)
+
+
+def print_watch_status(now, fetches, heap, tasks):
+  '''Print a status line for watch_server(), including how far behind
+  schedule it is: how long the oldest expired, but not yet refreshed, image
+  has been waiting.'''
+  overdue = [expiry for expiry, _, _ in heap if expiry <= now]
+  overdue.extend(tasks.values())
+  behind = (now - min(overdue)).total_seconds() if overdue else 0.0
+  print('%s: %d fetches, %d in flight, %d overdue, %.1fs behind schedule' % (
+      now.isoformat(timespec='seconds'), fetches, len(tasks), len(overdue),
+      behind), flush=True)
+
+
+async def watch_server(conn, session, jobs):
+  '''Keep server images up-to-date indefinitely, revalidating each one as
+  soon as it expires.
+
+  Only the rows that exist when watching starts are watched. Images are
+  classified as they are fetched, so that the cached states stay current. The
+  metrics are exported along with each status line.
+  '''
+  heap = []
+  cur = conn.execute('''SELECT wiki_name, server_url, server_age,
+      server_max_age, server_fetched_at FROM images WHERE server_url != ""''')
+  now = datetime.now(tz=timezone.utc)
+  while result := cur.fetchmany(50):
+    for (wiki_name, server_url, server_age, server_max_age,
+        server_fetched_at) in result:
+      expiry = get_expiry(server_fetched_at, server_max_age, server_age)
+      heapq.heappush(heap, (expiry or now, wiki_name, server_url))
+  print('Watching %d server images' % len(heap), flush=True)
+
+  fetches = 0
+  # Map from in-flight refresh tasks to the expiry time they're handling.
+  tasks = {}
+  # Set when the heap changes, to wake up the scheduling loop.
+  rescheduled = asyncio.Event()
+
+  async def refresh(queue, fetched_queue, wiki_name, server_url):
+    nonlocal fetches
+    try:
+      # The validators may have changed since the row was queued.
+      server_etag, server_last_modified = conn.execute(
+          '''SELECT server_etag, server_last_modified FROM images
+          WHERE wiki_name = ?''', [wiki_name]).fetchone()
+      _, new_expiry = await fetch_server_image(conn, session, queue,
+          fetched_queue, wiki_name, server_url, server_etag,
+          server_last_modified)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      print('Failed to download %s: %s' % (wiki_name, describe_error(e)),
+          file=sys.stderr)
+      new_expiry = None
+    except Exception as e:
+      # Anything else (like a DB error, or a bad image) mustn't end the task
+      # before the image is rescheduled, or it would never be watched again.
+      print('Failed to refresh %s: %r' % (wiki_name, e), file=sys.stderr)
+      new_expiry = None
+    fetches += 1
+    # Without a max-age (or after a failure) there's no schedule to follow,
+    # so try again after a default interval.
+    now = datetime.now(tz=timezone.utc)
+    if not new_expiry or new_expiry <= now:
+      new_expiry = now + timedelta(seconds=WATCH_DEFAULT_TTL)
+    heapq.heappush(heap, (new_expiry, wiki_name, server_url))
+    rescheduled.set()
+
+  next_status = datetime.now(tz=timezone.utc)
+  with make_executor(jobs) as executor:
+    async with checkpointed_writes(conn) as queue:
+      async with pipelined_classification(
+          conn, executor, jobs, queue) as fetched_queue:
+        while True:
+          now = datetime.now(tz=timezone.utc)
+          if now >= next_status:
+            print_watch_status(now, fetches, heap, tasks)
+            metrics.export()
+            next_status = now + timedelta(seconds=WATCH_STATUS_INTERVAL)
+          if heap and heap[0][0] <= now:
+            expiry, wiki_name, server_url = heapq.heappop(heap)
+            task = asyncio.create_task(refresh(
+                queue, fetched_queue, wiki_name, server_url))
+            tasks[task] = expiry
+            task.add_done_callback(tasks.pop)
+            continue
+          wake = next_status
+          if heap:
+            wake = min(wake, heap[0][0])
+          rescheduled.clear()
+          try:
+            await asyncio.wait_for(rescheduled.wait(),
+                max((wake - now).total_seconds(), 0.0))
+          except asyncio.TimeoutError:
+            pass
 
 
-async def do_download(conn, session, force_reload):
+async def do_download(conn, session, force_reload, classify_jobs=0):
+  '''Download wiki and server images. If classify_jobs is non-zero, server
+  images are also classified as they arrive, using that many workers.'''
   await do_download_wiki(conn, session)
-  await do_download_server(conn, session, force_reload)
+  if classify_jobs:
+    executor = make_executor(classify_jobs)
+  else:
+    executor = contextlib.nullcontext()
+  with executor:
+    await do_download_server(conn, session, force_reload,
+        executor if classify_jobs else None, classify_jobs)
+  deleted = delete_unused_blobs(conn)
+  if deleted:
+    print('Deleted %d unused images\n' % deleted)
+
+
+def get_state_key(wiki_hash, server_hash, server_status):
+  '''Get a key that changes whenever the inputs to a row's state change.
+
+  This is what the cached state is checked against. Since the images are
+  stored by content hash, this catches every change to either side.
+  '''
+  return '%s/%s/%d' % (wiki_hash, server_hash, server_status != 0)
+
 
+def classify_batch(batch):
+  '''Compute states for a batch of get_state() argument tuples.
 
-COUNT = 'count'
-def group_files(conn):
-  '''Return a dictionary, providing summary counts and individual statuses.'''
-  cur = conn.execute('''SELECT wiki_name, wiki_categories, wiki_image,
-      server_image, server_status FROM images''')
-  summary = {}
-  pair_table = {}
+  This is the unit of work sent to worker processes by classify_rows(). Returns
+  the states, and the timers of the work, for Metrics.merge_timers().
+  '''
+  timings = Metrics()
+  states = [get_state(*args, timings=timings) for args in batch]
+  return states, dict(timings.timers)
+
+
+def classify_rows(conn, rows, jobs):
+  '''Load the images for (wiki_name, wiki_hash, server_hash) rows and compute
+  their states, using a pool of worker processes if jobs > 1.
+
+  Returns the list of states, in the same order as rows.
+  '''
+  def gen_batches():
+    for i in range(0, len(rows), CLASSIFY_BATCH_SIZE):
+      batch = []
+      for wiki_name, wiki_hash, server_hash in rows[i:i + CLASSIFY_BATCH_SIZE]:
+        batch.append((wiki_name, load_blob(conn, wiki_hash),
+            load_blob(conn, server_hash)))
+      yield batch
+
+  states = []
+
+  def add_result(result):
+    batch_states, timers = result
+    states.extend(batch_states)
+    metrics.merge_timers(timers)
+
+  if jobs <= 1:
+    for batch in gen_batches():
+      add_result(classify_batch(batch))
+    return states
+  with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+    # Only keep a few batches in flight per worker, so that we don't load
+    # every image in the DB into memory at once.
+    pending = collections.deque()
+    for batch in gen_batches():
+      if len(pending) >= 2 * jobs:
+        add_result(pending.popleft().result())
+      pending.append(executor.submit(classify_batch, batch))
+    while pending:
+      add_result(pending.popleft().result())
+  return states
+
+
+def update_states(conn, jobs=1):
+  '''Bring the cached group and state of every row up-to-date.
+
+  Only rows whose state key has changed are reclassified. Images are only
+  loaded when the state can't be told from the hashes alone, which includes
+  the pixel hashes stored when the images were downloaded.
+  '''
+  # Rows that have been mapped already got their group then.
+  conn.execute('''UPDATE images
+      SET wiki_group = get_group(wiki_name, wiki_categories)
+      WHERE NOT mapped AND
+      wiki_group IS NOT get_group(wiki_name, wiki_categories)''')
+  # Don't hold the write lock while classifying, which can take a while.
+  if conn.in_transaction:
+    conn.execute('COMMIT')
+  cur = conn.execute('''SELECT wiki_name, wiki_hash, server_hash, server_status,
+      (SELECT pixel_hash FROM blobs WHERE hash = wiki_hash),
+      (SELECT pixel_hash FROM blobs WHERE hash = server_hash)
+      FROM images WHERE state = "" OR
+      state_key != get_state_key(wiki_hash, server_hash, server_status)''')
+  stale = []
+  updates = []
   while result := cur.fetchmany(50):
-    for wiki_name, categories, wiki_image, server_image, server_status in result:
-      summary[COUNT] = summary.get(COUNT, 0) + 1
-      group_name = get_group(wiki_name, categories)
-      group = summary.setdefault(group_name, {})
-      group[COUNT] = group.get(COUNT, 0) + 1
-      state = get_state(wiki_name, wiki_image, server_image, server_status)
-      if group_name in [GROUP_SMALL, GROUP_REGULAR]:
-        pair_table[wiki_name[:-4]] = state
+    for (wiki_name, wiki_hash, server_hash, server_status, wiki_pixels,
+        server_pixels) in result:
+      new_key = get_state_key(wiki_hash, server_hash, server_status)
+      state = get_quick_state(wiki_hash, server_hash, server_status,
+          wiki_pixels, server_pixels)
+      if state:
+        updates.append([state, new_key, wiki_name])
       else:
-        state_list = group.setdefault(state, [0])
-        state_list[0] += 1
-        state_list.append(wiki_name)
-  for name, state in pair_table.items():
-    if name.endswith('small'):
-      group_name = GROUP_SMALL
-      other_name = name[:-5]
-    else:
-      group_name = GROUP_REGULAR
-      other_name = name + 'small'
-    pairing = 'Paired' if other_name in pair_table else 'Unpaired'
-    subgroup = summary[group_name].setdefault(pairing, {})
-    subgroup[COUNT] = subgroup.get(COUNT, 0) + 1
-    state_list = subgroup.setdefault(state, [0])
-    state_list[0] += 1
-    state_list.append(name + '.png')
-  return summary
-
-
-def print_summary(conn):
+        stale.append((wiki_name, wiki_hash, server_hash, new_key))
+  if stale:
+    new_states = classify_rows(conn, [x[:3] for x in stale], jobs)
+    for (wiki_name, _, _, new_key), state in zip(stale, new_states):
+      updates.append([state, new_key, wiki_name])
+  if updates:
+    conn.executemany(
+        'UPDATE images SET state = ?, state_key = ? WHERE wiki_name = ?',
+        updates)
+  if conn.in_transaction:
+    conn.execute('COMMIT')
+
+
+# The name shared by both halves of a regular/small pair of images: the file
+# name without ".png", and without "small" for the small half. NULL for
+# non-PNG files.
+PAIR_BASE = '''CASE
+    WHEN substr(wiki_name, -9) = 'small.png'
+      THEN substr(wiki_name, 1, length(wiki_name) - 9)
+    WHEN substr(wiki_name, -4) = '.png'
+      THEN substr(wiki_name, 1, length(wiki_name) - 4)
+    END'''
+
+# The cached group and state of each row, along with whether it's "Paired"
+# or "Unpaired" for Small and Regular images (NULL otherwise). An image is
+# paired if the other half of its pair is in the other one of those two
+# groups, which is an indexed lookup on pair_base. Rows that have never been
+# classified are left out, which only happens with --read-only.
+STATE_ROWS = '''SELECT rowid, wiki_name, wiki_group, state,
+    CASE WHEN wiki_group NOT IN ('%(small)s', '%(regular)s') THEN NULL
+    WHEN EXISTS (SELECT 1 FROM images AS other
+        WHERE other.pair_base = images.pair_base AND
+        other.wiki_group IN ('%(small)s', '%(regular)s') AND
+        other.wiki_group != images.wiki_group)
+    THEN 'Paired' ELSE 'Unpaired' END AS pairing
+    FROM images WHERE state != '' AND wiki_group NOT NULL''' % {'small': GROUP_SMALL, 'regular': GROUP_REGULAR}
+PAIRINGS = ['Paired', 'Unpaired']
+
+
+def order_by(column, values):
+  '''Return (sql, params) for an expression that sorts column in the order of
+  values.'''
+  return ('CASE %s %s END' % (column, ' '.join(
+      'WHEN ? THEN %d' % i for i in range(len(values)))), list(values))
+
+
+def get_row_writer(output_format, fields):
+  '''Get a function that writes a record (a sequence matching fields) to
+  stdout, as CSV (with a header row) or as JSON Lines.'''
+  if output_format == 'csv':
+    writer = csv.writer(sys.stdout)
+    writer.writerow(fields)
+    return writer.writerow
+  return lambda row: print(json.dumps(dict(zip(fields, row))))
+
+
+def prepare_states(conn, jobs, read_only):
+  '''Helper for print_summary() and print_report().
+
+  Brings the cached states up-to-date, or if the DB is read-only, warns about
+  any that are out of date instead.
+  '''
+  if not read_only:
+    update_states(conn, jobs)
+    return
+  stale = conn.execute('''SELECT count(*) FROM images WHERE state = "" OR
+      state_key != get_state_key(wiki_hash, server_hash, server_status) OR
+      (NOT mapped AND
+        wiki_group IS NOT get_group(wiki_name, wiki_categories))'''
+      ).fetchone()[0]
+  if stale:
+    print('warning: %d rows have out-of-date or missing states; run without '
+        '--read-only to update them.' % stale, file=sys.stderr)
+
+
+def print_summary(conn, jobs, output_format='text', read_only=False):
   '''Print a summarized report of the DB.'''
-  def print_leaf(indent, group, g):
-    for s in STATES:
-      if s not in group:
-        continue
-      print('%s%s%d %s' % ('*' * indent, ' ' * indent, group[s][0], s))
+  prepare_states(conn, jobs, read_only)
+  # This is tiny (at most one row per group, pairing and state), so it's fine
+  # to hold on to.
+  counts = conn.execute('''SELECT wiki_group, pairing, state, count(*)
+      FROM (%s) GROUP BY wiki_group, pairing, state''' % STATE_ROWS).fetchall()
+  counts.sort(key=lambda x: (GROUPS.index(x[0]),
+      PAIRINGS.index(x[1]) if x[1] else len(PAIRINGS), STATES.index(x[2])))
+  if output_format != 'text':
+    write_row = get_row_writer(output_format,
+        ['group', 'pairing', 'state', 'count'])
+    for row in counts:
+      write_row(row)
+    return
 
-  summary = group_files(conn)
-  print('* %d Game Files' % summary[COUNT])
+  def total(group=None, pairing=None):
+    return sum(x[3] for x in counts if group in (None, x[0]) and (
+        pairing in (None, x[1])))
+
+  print('* %d Game Files' % total())
   for g in GROUPS:
-    if g not in summary:
+    if not total(g):
       continue
-    group = summary[g]
-    print('**  %d %s' % (group[COUNT], g))
-    for s in ['Paired', 'Unpaired']:
-      if s not in group:
+    print('**  %d %s' % (total(g), g))
+    for p in PAIRINGS:
+      if not total(g, p):
         continue
-      print('***   %d %s' % (group[s][COUNT], s))
-      print_leaf(4, group[s], s)
-    print_leaf(3, group, g)
+      print('***   %d %s' % (total(g, p), p))
+      for group, pairing, state, count in counts:
+        if group == g and pairing == p:
+          print('****    %d %s' % (count, state))
+    for group, pairing, state, count in counts:
+      if group == g and not pairing:
+        print('***   %d %s' % (count, state))
   cur = conn.execute('''SELECT left.wiki_name, right.wiki_name,
        left.wiki_categories, right.wiki_categories
-     FROM images as left, images as right
-     ON substr(left.wiki_name, 1, length(left.wiki_name) - 4) || "small.png" = right.wiki_name
-     WHERE left.wiki_name like "%.png" AND
-     (left.wiki_categories != "" OR right.wiki_categories != "")''')
+     FROM images as left JOIN images as right ON left.pair_base = right.pair_base
+     WHERE substr(left.wiki_name, -9) != "small.png" AND
+     substr(right.wiki_name, -9) = "small.png" AND
+     (left.wiki_categories != "" OR right.wiki_categories != "")
+     ORDER BY left.rowid''')
   result = cur.fetchall()
   print('\n%d False pairings ' % len(result) +
       '(Named like pairings, but actually cross-category):')
@@ -473,39 +1755,258 @@ def print_summary(conn):
         (item[0], item[1], ['1st', '2nd'][which], item[2+which]))
 
 
-def print_report(conn, states):
+def print_report(conn, states, jobs, output_format='text', read_only=False):
   '''Print a summarized report of the DB.'''
-  def print_leaf(indent, group, g):
-    header = (indent * '*') + (indent * ' ')
-    header2 = '*' + header + ' '
-    for s in states:
-      if s not in group:
-        continue
-      print('%s%s:' % (header, s))
-      print('\n'.join(header2 + x for x in group[s][1:]))
-
   for state in states:
     if state not in STATES:
       raise ValueError('"%s" is not a valid state from %s' % (state, STATES))
-  grouping = group_files(conn)
+  prepare_states(conn, jobs, read_only)
+  state_order, state_params = order_by('state', states)
+  group_order, group_params = order_by('wiki_group', GROUPS)
+  if output_format != 'text':
+    write_row = get_row_writer(output_format,
+        ['group', 'pairing', 'state', 'wiki_name'])
+    cur = conn.execute('''SELECT wiki_group, pairing, state, wiki_name
+        FROM (%s) WHERE state IN (%s)
+        ORDER BY %s, pairing IS NULL, pairing, %s, rowid''' % (
+            STATE_ROWS, ','.join('?' * len(states)), group_order,
+            state_order), states + group_params + state_params)
+    while result := cur.fetchmany(50):
+      for row in result:
+        write_row(row)
+    return
+
+  def print_leaf(indent, group, pairing):
+    header = (indent * '*') + (indent * ' ')
+    header2 = '*' + header + ' '
+    cur = conn.execute('''SELECT state, wiki_name FROM (%s)
+        WHERE wiki_group = ? AND pairing IS ? AND state IN (%s)
+        ORDER BY %s, rowid''' % (
+            STATE_ROWS, ','.join('?' * len(states)), state_order),
+        [group, pairing] + states + state_params)
+    last_state = None
+    while result := cur.fetchmany(50):
+      for state, wiki_name in result:
+        if state != last_state:
+          print('%s%s:' % (header, state))
+          last_state = state
+        print(header2 + wiki_name)
+
+  # Which groups and pairings exist at all, regardless of the states asked
+  # for, since their headers are printed even when they're empty.
+  present = set(conn.execute('''SELECT DISTINCT wiki_group, pairing
+      FROM (%s)''' % STATE_ROWS).fetchall())
   for g in GROUPS:
-    if g not in grouping:
+    if not any(group == g for group, _ in present):
       continue
-    group = grouping[g]
     print('* %s' % g)
-    for s in ['Paired', 'Unpaired']:
-      if s not in group:
+    for p in PAIRINGS:
+      if (g, p) not in present:
         continue
-      print('**  %s' % s)
-      print_leaf(3, group[s], s)
-    print_leaf(2, group, g)
+      print('**  %s' % p)
+      print_leaf(3, g, p)
+    print_leaf(2, g, None)
+
+
+def copy_blob(conn, rowid, path):
+  '''Write the data of a row of the blobs table to a file, a chunk at a time,
+  without loading all of it into memory.'''
+  with open(path, 'wb') as f:
+    if not hasattr(conn, 'blobopen'):
+      # Incremental blob I/O needs Python 3.11.
+      f.write(conn.execute(
+          'SELECT data FROM blobs WHERE rowid = ?', [rowid]).fetchone()[0])
+      return
+    with conn.blobopen('blobs', 'data', rowid, readonly=True) as blob:
+      while chunk := blob.read(EXPORT_CHUNK_SIZE):
+        f.write(chunk)
+
+
+def export_images(conn, directory, states, jobs, read_only=False):
+  '''Write the server images of the rows in the given states to directory,
+  for uploading to the wiki, along with a manifest.csv that maps each wiki
+  name to its file.
+
+  Each file is named after the wiki file it should replace. Only one image is
+  in memory at a time (or less, with incremental blob I/O).
+  '''
+  for state in states:
+    if state not in STATES:
+      raise ValueError('"%s" is not a valid state from %s' % (state, STATES))
+  prepare_states(conn, jobs, read_only)
+  os.makedirs(directory, exist_ok=True)
+  print('Exporting', end='', flush=True)
+  cur = conn.execute('''SELECT images.wiki_name, images.state,
+      images.server_url, blobs.rowid, blobs.sha1
+      FROM images JOIN blobs ON blobs.hash = images.server_hash
+      WHERE images.state IN (%s) ORDER BY images.wiki_name''' % (
+          ','.join('?' * len(states))), states)
+  count = 0
+  with open(os.path.join(directory, 'manifest.csv'), 'w',
+      newline='') as manifest:
+    writer = csv.writer(manifest)
+    writer.writerow(['wiki_name', 'file', 'state', 'server_url', 'sha1'])
+    while result := cur.fetchmany(50):
+      for wiki_name, state, server_url, rowid, sha1 in result:
+        # Trim "File:", and keep the name from escaping the directory.
+        filename = wiki_name[5:].replace('/', '_').replace(os.sep, '_')
+        copy_blob(conn, rowid, os.path.join(directory, filename))
+        writer.writerow([wiki_name, filename, state, server_url, sha1])
+        count += 1
+        if count % 10 == 0:
+          print('.', end='', flush=True)
+  print(' %d images exported to %s' % (count, directory))
+
+
+# Columns that were added after the tables were first created, which
+# "CREATE TABLE IF NOT EXISTS" won't add for us.
+ADDED_COLUMNS = {
+  'images': {
+    'state': 'TEXT NOT NULL DEFAULT ""',
+    'state_key': 'TEXT NOT NULL DEFAULT ""',
+    'wiki_hash': 'TEXT',
+    'server_hash': 'TEXT',
+    'wiki_sha1': 'TEXT',
+    'wiki_etag': 'TEXT NOT NULL DEFAULT ""',
+    'wiki_last_modified': 'TEXT NOT NULL DEFAULT ""',
+    'wiki_group': 'TEXT',
+    'mapped': 'INTEGER NOT NULL DEFAULT 0',
+    'pair_base': 'TEXT GENERATED ALWAYS AS (%s) VIRTUAL' % PAIR_BASE,
+  },
+  'blobs': {
+    'sha1': 'TEXT',
+    'dhash': 'TEXT',
+    'pixel_hash': 'TEXT',
+  },
+}
+
+
+def get_columns(conn, table):
+  '''Get the names of all the columns in a table, including generated ones.'''
+  return {row[1] for row in conn.execute('PRAGMA table_xinfo(%s)' % table)}
+
+
+def register_functions(conn):
+  '''Register the SQL functions that the queries and schema use.'''
+  conn.create_function('blob_hash', 1,
+      lambda data: data and get_blob_hash(data), deterministic=True)
+  conn.create_function('blob_sha1', 1,
+      lambda data: data and get_sha1(data), deterministic=True)
+  conn.create_function('get_group', 2, get_group, deterministic=True)
+  conn.create_function('get_state_key', 3, get_state_key, deterministic=True)
+
+
+def open_db(read_only=False):
+  '''Open the DB and tune it.
+
+  A read-only connection never takes the write lock, and in WAL mode readers
+  see a consistent snapshot of the DB without blocking a writer, or being
+  blocked by it.
+  '''
+  if read_only:
+    conn = sqlite3.connect('file:%s?mode=ro' % DB_FILE, uri=True,
+        timeout=DB_BUSY_TIMEOUT, factory=TimedConnection)
+  else:
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT,
+        factory=TimedConnection)
+    conn.execute('PRAGMA page_size = %d' % DB_PAGE_SIZE)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # In WAL mode this is still safe against corruption; it can only lose the
+    # most recent commits on a power failure.
+    conn.execute('PRAGMA synchronous = NORMAL')
+  conn.isolation_level = 'EXCLUSIVE'
+  conn.execute('PRAGMA cache_size = -%d' % DB_CACHE_KIB)
+  conn.execute('PRAGMA mmap_size = %d' % DB_MMAP_SIZE)
+  register_functions(conn)
+  return conn
+
+
+def init_db(conn):
+  '''Create the DB tables, and add any columns missing from older DBs.'''
+  conn.execute('''CREATE TABLE IF NOT EXISTS images (
+      wiki_name TEXT PRIMARY KEY,
+      wiki_url TEXT NOT NULL,
+      wiki_revision TEXT NOT NULL DEFAULT "",
+      wiki_categories TEXT NOT NULL DEFAULT "",
+      wiki_group TEXT,
+      mapped INTEGER NOT NULL DEFAULT 0,
+      pair_base TEXT GENERATED ALWAYS AS (%s) VIRTUAL,
+      wiki_sha1 TEXT,
+      wiki_hash TEXT,
+      wiki_etag TEXT NOT NULL DEFAULT "",
+      wiki_last_modified TEXT NOT NULL DEFAULT "",
+      server_url TEXT NOT NULL DEFAULT "",
+      server_status INTEGER NOT NULL DEFAULT 0,
+      server_etag TEXT NOT NULL DEFAULT "",
+      server_last_modified TEXT NOT NULL DEFAULT "",
+      server_age INTEGER NOT NULL DEFAULT 0,
+      server_max_age INTEGER NOT NULL DEFAULT 0,
+      server_fetched_at INTEGER NOT NULL DEFAULT 0,
+      server_hash TEXT,
+      state TEXT NOT NULL DEFAULT "",
+      state_key TEXT NOT NULL DEFAULT ""
+      )''' % PAIR_BASE)
+  # Images are stored here, keyed by their SHA-256, so that identical files
+  # are only stored once. The images table refers to them by hash. The SHA-1
+  # is what the wiki API reports, and is used to find files we already have.
+  # The dHash is a perceptual hash, filled in as --find-renames needs it (an
+  # empty string for images that can't be decoded). The pixel hash is filled
+  # in when the blob is downloaded (see get_pixel_hash()), and is NULL for
+  # images that can't be decoded, or that were stored by older versions of
+  # this script; those are compared by decoding them, as before.
+  conn.execute('''CREATE TABLE IF NOT EXISTS blobs (
+      hash TEXT PRIMARY KEY,
+      sha1 TEXT,
+      dhash TEXT,
+      pixel_hash TEXT,
+      data BLOB NOT NULL
+      )''')
+  existing = {}
+  for table, columns in ADDED_COLUMNS.items():
+    existing[table] = get_columns(conn, table)
+    for name, definition in columns.items():
+      if name not in existing[table]:
+        conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            table, name, definition))
+  if 'sha1' not in existing['blobs']:
+    conn.execute('UPDATE blobs SET sha1 = blob_sha1(data)')
+    conn.execute('COMMIT')
+  conn.execute('CREATE INDEX IF NOT EXISTS blobs_sha1 ON blobs (sha1)')
+  conn.execute('''CREATE INDEX IF NOT EXISTS images_group_state
+      ON images (wiki_group, state)''')
+  conn.execute(
+      'CREATE INDEX IF NOT EXISTS images_pair_base ON images (pair_base)')
+  # New rows start out unmapped, and a change of categories (which can
+  # change the group) makes a row unmapped again, so that update_map() only
+  # has to look at those, and the few rows whose fetch failed. (This replaces
+  # an index of just the unmapped rows, which it also serves for.)
+  conn.execute('DROP INDEX IF EXISTS images_unmapped')
+  conn.execute('''CREATE INDEX IF NOT EXISTS images_remap
+      ON images (wiki_name) WHERE NOT mapped OR server_status >= 400''')
+  conn.execute('''CREATE TRIGGER IF NOT EXISTS images_categories_changed
+      AFTER UPDATE OF wiki_categories ON images
+      WHEN OLD.wiki_categories IS NOT NEW.wiki_categories
+      BEGIN UPDATE images SET mapped = 0 WHERE rowid = NEW.rowid; END''')
+  # Older DBs stored the images inline; move them into the blobs table.
+  if 'wiki_image' in existing['images']:
+    print('Moving images into the blobs table... ', end='', flush=True)
+    for image_column, hash_column in [
+        ('wiki_image', 'wiki_hash'), ('server_image', 'server_hash')]:
+      conn.execute('''INSERT OR IGNORE INTO blobs (hash, sha1, data)
+          SELECT blob_hash(%s), blob_sha1(%s), %s FROM images
+          WHERE %s NOT NULL''' % ((image_column,) * 4))
+      conn.execute('UPDATE images SET %s = blob_hash(%s)' % (
+          hash_column, image_column))
+      conn.execute('ALTER TABLE images DROP COLUMN %s' % image_column)
+    conn.execute('COMMIT')
+    print('Done! (Run VACUUM on the DB to reclaim the space.)')
 
 
 async def main():
   docs = __doc__.split('\n', 1)
   parser = argparse.ArgumentParser(description=docs[0], epilog='''
       If no arguments are given, the default is -cmds, i.e. to refresh
-      everything and summarize.''')
+      everything and summarize (or just -s with --read-only).''')
   parser.add_argument('-c', '--categories', action='store_true',
       help='Refresh the list of game files by reading from the categories pages.')
   parser.add_argument('-m', '--map', action='store_true',
@@ -518,69 +2019,158 @@ async def main():
       Force a check for new server resources, even if they haven't
       expired yet. (Wiki images are always fully checked.)''')
   parser.add_argument('-s', '--summary', action='store_true',
-      help='Output a summary of the current state of the DB, without modifying anything.')
+      help='''Output a summary of the current state of the DB, without
+      modifying anything other than the cached comparison results.''')
   parser.add_argument('-r', '--report', nargs='?',
       const=','.join([STATE_CANT_FETCH, STATE_SIZE_MISMATCH, STATE_TOO_DIFFERENT]),
-      help='''Output a detailed report, without modifying anything.
+      help='''Output a detailed report, without modifying anything other
+      than the cached comparison results.
       The argument is a comma-separated list of states to report for,
       defaulting to those that were attempted but not matching.''')
+  parser.add_argument('--format', choices=['text', 'csv', 'json'],
+      default='text', help='''Output format for --summary and --report. The
+      csv and json (JSON Lines) formats output one record per group, pairing
+      and state for --summary (without the false pairings), and one per image
+      for --report.''')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='''
+      Number of worker processes to use when comparing images for --summary
+      and --report.''')
+  parser.add_argument('-w', '--watch', action='store_true', help='''
+      After everything else, keep running and revalidate each server image
+      as soon as it expires, printing a status line every %d seconds.''' %
+      WATCH_STATUS_INTERVAL)
+  parser.add_argument('-a', '--api', action='store_true', help='''
+      Use the MediaWiki API instead of the category pages to list game files.
+      This is much faster, and lets downloads of files that are already
+      stored be skipped.''')
+  parser.add_argument('--wiki-url', default=WIKI_URL, help='''
+      Base URL of the wiki to list game files from. Mostly useful for
+      testing against a local server.''')
+  parser.add_argument('--server-url', default=SERVER_URL, help='''
+      Base URL of the server that --map maps game files to. Mostly useful for
+      testing against a local server.''')
   parser.add_argument('--cookie', help='''Set of cookies to send with
       requests to the wiki. Use this to make edits under your username. Get
       this by grabbing the cookie argument from a request in your browser,
       with DevTools.''')
+  parser.add_argument('--find-renames', action='store_true', help='''
+      For images that couldn't be fetched from the server, suggest server
+      URLs whose images look similar to the wiki image.''')
+  parser.add_argument('--check-compare', action='store_true', help='''
+      Classify every image pair with both the numpy and the pure-Pillow
+      comparison code, and report any pairs where they disagree.''')
+  parser.add_argument('--export', metavar='DIR', help='''
+      Write the server images of the images in the --export-states to DIR,
+      named after the wiki files they should replace, along with a
+      manifest.csv for uploading them in bulk.''')
+  parser.add_argument('--export-states',
+      default=','.join([STATE_SIZE_MISMATCH, STATE_TOO_DIFFERENT]),
+      help='''Comma-separated list of states to --export the images of,
+      defaulting to "%(default)s".''')
+  parser.add_argument('--metrics', metavar='FILE', help='''
+      Write metrics about the run to FILE (or stdout, for "-") at the end: the
+      time spent in each phase, request latencies and sizes by host and
+      status, and the time spent in SQLite and comparing images. With
+      --watch, the file is also rewritten with each status line.''')
+  parser.add_argument('--metrics-format', choices=['json', 'prometheus'],
+      default='json', help='''Format for --metrics. The prometheus format
+      is the text exposition format, e.g. for the node_exporter textfile
+      collector.''')
+  parser.add_argument('-R', '--read-only', action='store_true', help='''
+      Open the DB read-only and report the states as they were last cached,
+      so that --summary, --report and --export can be run while another
+      refresh is in progress.''')
 
   args = parser.parse_args()
   if not (args.categories or args.map or args.download or
-      args.summary or args.report):
-    args.categories = True
-    args.map = True
-    args.download = True
+      args.summary or args.report or args.find_renames or args.check_compare
+      or args.watch or args.export):
+    if not args.read_only:
+      args.categories = True
+      args.map = True
+      args.download = True
     args.summary = True
 
   if (not args.map) and args.overwrite:
     print("warning: --overwrite without --map does nothing!", file=sys.stderr)
 
+  if (not args.categories) and args.api:
+    print("warning: --api without --categories does nothing!", file=sys.stderr)
+
+  if args.metrics:
+    metrics.output = (args.metrics, args.metrics_format)
+
   if (not args.download) and args.force_reload:
     print("warning: --force-reload without --download does nothing!",
           file=sys.stderr)
 
-  conn = sqlite3.connect('images.db')
-  conn.isolation_level = 'EXCLUSIVE'
-  conn.execute('''CREATE TABLE IF NOT EXISTS images (
-      wiki_name TEXT PRIMARY KEY,
-      wiki_url TEXT NOT NULL,
-      wiki_revision TEXT NOT NULL DEFAULT "",
-      wiki_categories TEXT NOT NULL DEFAULT "",
-      wiki_image BLOB,
-      server_url TEXT NOT NULL DEFAULT "",
-      server_status INTEGER NOT NULL DEFAULT 0,
-      server_etag TEXT NOT NULL DEFAULT "",
-      server_last_modified TEXT NOT NULL DEFAULT "",
-      server_age INTEGER NOT NULL DEFAULT 0,
-      server_max_age INTEGER NOT NULL DEFAULT 0,
-      server_fetched_at INTEGER NOT NULL DEFAULT 0,
-      server_image BLOB
-      )''')
+  if args.read_only:
+    if (args.categories or args.map or args.download or args.find_renames or
+        args.check_compare or args.watch):
+      parser.error('--read-only can only be used with --summary, --report '
+          'and --export')
+    conn = open_db(read_only=True)
+    if any(not columns.keys() <= get_columns(conn, table)
+        for table, columns in ADDED_COLUMNS.items()):
+      parser.error('the DB is from an older version of this script; '
+          'run it once without --read-only to upgrade it')
+    # Report from a single snapshot, even if a refresh commits meanwhile.
+    conn.execute('BEGIN')
+  else:
+    conn = open_db()
+    init_db(conn)
 
   cookies = {}
   if args.cookie:
     cookie_list = args.cookie.split(', ')
     cookies = dict(x.split('=', 1) for x in cookie_list)
-  async with aiohttp.ClientSession(cookies=cookies) as session:
-    if args.categories:
-      await update_categories(conn, session)
+  # The metrics are exported even if the run fails or is interrupted, since
+  # that's when they're most interesting.
+  try:
+    async with make_session(cookies) as session:
+      if args.categories:
+        with metrics.phase('categories'):
+          await update_categories(conn, session, args.wiki_url, args.api)
+
+      if args.map:
+        with metrics.phase('map'):
+          update_map(conn, args.overwrite, args.server_url)
+
+      if args.download:
+        # When we're going to summarize afterwards anyway, classify the
+        # images while they are downloading, instead of afterwards.
+        with metrics.phase('download'):
+          await do_download(conn, session, args.force_reload,
+              args.jobs if args.summary or args.report else 0)
+
+      if args.summary:
+        with metrics.phase('summary'):
+          print_summary(conn, args.jobs, args.format, args.read_only)
+
+      if args.report:
+        with metrics.phase('report'):
+          print_report(conn, args.report.split(','), args.jobs, args.format,
+              args.read_only)
 
-    if args.map:
-      update_map(conn, args.overwrite)
+      if args.export:
+        with metrics.phase('export'):
+          export_images(conn, args.export, args.export_states.split(','),
+              args.jobs, args.read_only)
 
-    if args.download:
-      await do_download(conn, session, args.force_reload)
+      if args.find_renames:
+        with metrics.phase('find-renames'):
+          find_renames(conn)
 
-    if args.summary:
-      print_summary(conn)
+      if args.check_compare:
+        with metrics.phase('check-compare'):
+          if not check_compare(conn):
+            sys.exit(1)
 
-    if args.report:
-      print_report(conn, args.report.split(','))
+      if args.watch:
+        with metrics.phase('watch'):
+          await watch_server(conn, session, args.jobs)
+  finally:
+    metrics.export()
 
 if __name__ == '__main__':
   asyncio.run(main())